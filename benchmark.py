@@ -0,0 +1,259 @@
+"""
+Benchmark del Gestore Firme Email su una directory LDAP simulata
+
+Popola una directory in memoria (strategia MOCK_SYNC di ldap3) con N utenti
+sintetici distribuiti su più OU e misura separatamente:
+  - ldap:     solo trasferimento delle pagine da ldap3 (riferimento, senza il codice del gestore)
+  - pages:    iter_user_pages(): ricerca paged results e costruzione degli ADUser
+  - search:   search_users() sull'intera directory
+  - html/txt: generazione delle firme
+  - render_pN: generazione HTML+TXT su N processi (render_parallel), da
+               confrontare con render (html + txt su un solo processo)
+  - deploy:   scrittura delle firme nei profili (deploy_batch)
+  - deploy_user: deploy_signature_to_user() un utente alla volta, con la firma
+               predefinita su un registro in memoria (MemoryRegistry), verificata a fine fase
+  - save:     esportazione in cartella (deploy_batch con output_folder)
+  - archive:  esportazione in un unico archivio ZIP (export_archive)
+
+I risultati vengono scritti in JSON; con --baseline vengono confrontati con
+un'esecuzione precedente e lo script termina con exit code 1 se una fase è
+più lenta della tolleranza indicata.
+
+Uso:
+    python benchmark.py --sizes 1000,10000 --output benchmark_results.json
+    python benchmark.py --baseline benchmark_results.json --tolerance 0.25
+    python benchmark.py --sizes 100000 --processes 1,2,4,8
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+from contextlib import redirect_stdout
+from datetime import datetime
+
+from ldap3 import Server, Connection, MOCK_SYNC, OFFLINE_AD_2012_R2, SUBTREE
+
+import public
+
+
+BENCH_DOMAIN = 'DC=bench,DC=local'
+BENCH_OUS = ['Treviso', 'Perugia', 'Verona', 'Berlin']
+DEFAULT_SIZES = '1000,10000,100000'
+DEFAULT_OUTPUT = 'benchmark_results.json'
+DEFAULT_PROCESSES = '2,4'
+
+# Le fasi di scrittura su disco sono limitate per non riempire il disco a 100k utenti
+DEFAULT_MAX_WRITE_USERS = 10000
+
+
+def build_mock_directory(n_users, ous=BENCH_OUS):
+    """
+    Crea una connessione ldap3 MOCK_SYNC già in bind con n_users utenti sintetici
+
+    Returns:
+        Tupla (connessione, {nome OU: Base DN})
+    """
+    server = Server('bench-dc', get_info=OFFLINE_AD_2012_R2)
+    admin_dn = f'CN=bench-admin,{BENCH_DOMAIN}'
+    conn = Connection(server, user=admin_dn, password='bench', client_strategy=MOCK_SYNC)
+    conn.strategy.add_entry(admin_dn, {'userPassword': 'bench', 'sn': 'admin'})
+
+    bases = {}
+    for ou in ous:
+        bases[ou] = f'OU={ou},OU=Client,{BENCH_DOMAIN}'
+
+    for i in range(n_users):
+        ou = ous[i % len(ous)]
+        username = f'user{i:06d}'
+        attributes = {
+            'objectClass': ['top', 'person', 'organizationalPerson', 'user'],
+            'sAMAccountName': username,
+            'displayName': f'Utente {i:06d} (Carton Group)',
+            'givenName': 'Utente',
+            'sn': f'{i:06d}',
+            'title': ['Impiegato', 'Responsabile', 'Tecnico', 'Commerciale'][i % 4],
+            'mail': f'{username}@bench.local',
+            'telephoneNumber': f'+39 0422 {i:06d}',
+            'department': ['Vendite', 'Produzione', 'IT', 'Amministrazione'][i % 4],
+            'physicalDeliveryOfficeName': ou,
+            'sAMAccountType': '805306368',
+            'uSNChanged': str(10000 + i),
+        }
+        if i % 3 == 0:
+            attributes['mobile'] = f'+39 333 {i:06d}'
+        conn.strategy.add_entry(f'CN={username},{bases[ou]}', attributes)
+
+    conn.bind()
+    return conn, bases
+
+
+def timed(func, *args, **kwargs):
+    """Esegue func e restituisce (risultato, secondi)"""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def stage(seconds, count):
+    return {
+        'seconds': round(seconds, 6),
+        'count': count,
+        'per_second': round(count / seconds, 1) if seconds > 0 else None,
+    }
+
+
+def run_size(n_users, max_write_users, page_size, processes=()):
+    """Esegue tutte le fasi per una dimensione della directory"""
+    conn, bases = build_mock_directory(n_users)
+    workdir = tempfile.mkdtemp(prefix='firme-bench-')
+    manager = public.ADSignatureManager('bench-dc', 'BENCH', BENCH_DOMAIN, 'bench', 'bench',
+                                        state_file=f'{workdir}/state.json',
+                                        profiles_root=f'{workdir}/profili')
+    manager.connection = conn
+    manager.registry = public.MemoryRegistry()
+    # Il mock di ldap3 non supporta l'extensible match del filtro sugli account disabilitati
+    search_filter = public.build_search_filter(exclude_disabled=False)
+    results = {}
+
+    try:
+        # Riferimento: solo il trasferimento delle pagine da ldap3, senza costruire gli utenti
+        def transfer():
+            count = 0
+            cookie = None
+            while True:
+                conn.search(BENCH_DOMAIN, search_filter, SUBTREE,
+                            attributes=manager.search_attributes, paged_size=page_size, paged_cookie=cookie)
+                count += sum(1 for e in conn.response if e.get('type') == 'searchResEntry')
+                controls = conn.result.get('controls') or {}
+                cookie = controls.get(public.PAGED_RESULTS_OID, {}).get('value', {}).get('cookie')
+                if not cookie:
+                    return count
+
+        count, seconds = timed(transfer)
+        results['ldap'] = stage(seconds, count)
+
+        count, seconds = timed(lambda: sum(len(page) for page in manager.iter_user_pages(search_filter, page_size)))
+        results['pages'] = stage(seconds, count)
+
+        with redirect_stdout(None):
+            users, seconds = timed(manager.search_users, search_filter, page_size)
+        results['search'] = stage(seconds, len(users))
+
+        # Il primo rendering carica e compila i template: escluso dalla misura
+        manager.generate_signature_html(users[0])
+        manager.generate_signature_txt(users[0])
+
+        _, html_seconds = timed(lambda: [manager.generate_signature_html(u) for u in users])
+        results['html'] = stage(html_seconds, len(users))
+        _, txt_seconds = timed(lambda: [manager.generate_signature_txt(u) for u in users])
+        results['txt'] = stage(txt_seconds, len(users))
+        results['render'] = stage(html_seconds + txt_seconds, len(users))
+
+        # Include l'avvio dei processi e il trasferimento dei blocchi
+        for count in processes:
+            _, seconds = timed(lambda: sum(1 for _ in manager.render_parallel(users, count)))
+            results[f'render_p{count}'] = stage(seconds, len(users))
+
+        write_users = users[:max_write_users]
+        with redirect_stdout(None):
+            _, seconds = timed(manager.deploy_batch, write_users)
+        results['deploy'] = stage(seconds, len(write_users))
+        # Profili nuovi: con quelli di deploy le firme risulterebbero invariate
+        manager.profiles_root = f'{workdir}/profili_utente'
+        with redirect_stdout(None):
+            _, seconds = timed(lambda: [manager.deploy_signature_to_user(u) for u in write_users])
+        results['deploy_user'] = stage(seconds, len(write_users))
+        key_path, values = manager.default_signature_values()
+        if manager.registry.keys.get(key_path) != values:
+            raise RuntimeError(f"Firma predefinita non scritta nel registro: {manager.registry.keys}")
+        with redirect_stdout(None):
+            _, seconds = timed(manager.deploy_batch, write_users, f'{workdir}/firme')
+        results['save'] = stage(seconds, len(write_users))
+        with redirect_stdout(None):
+            _, seconds = timed(manager.export_archive, write_users, f'{workdir}/firme.zip')
+        results['archive'] = stage(seconds, len(write_users))
+    finally:
+        conn.unbind()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Confronta i tempi per utente con un'esecuzione precedente
+
+    Returns:
+        Lista di regressioni (stringhe leggibili)
+    """
+    regressions = []
+    for size, stages in results['sizes'].items():
+        for name, current in stages.items():
+            previous = baseline.get('sizes', {}).get(size, {}).get(name)
+            if not previous or not previous.get('per_second') or not current.get('per_second'):
+                continue
+            ratio = previous['per_second'] / current['per_second']
+            if ratio > 1 + tolerance:
+                regressions.append(f"{name} @ {size} utenti: {current['per_second']:.0f}/s "
+                                   f"contro {previous['per_second']:.0f}/s (-{(1 - 1 / ratio) * 100:.0f}%)")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del Gestore Firme Email su directory LDAP simulata")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help=f"numero di utenti sintetici, separati da virgola (default: {DEFAULT_SIZES})")
+    parser.add_argument('--page-size', type=int, default=public.DEFAULT_PAGE_SIZE,
+                        help="dimensione pagina della ricerca")
+    parser.add_argument('--max-write-users', type=int, default=DEFAULT_MAX_WRITE_USERS,
+                        help="utenti usati nelle fasi di scrittura su disco")
+    parser.add_argument('--processes', default=DEFAULT_PROCESSES,
+                        help=f"processi per le fasi render_pN, separati da virgola (default: {DEFAULT_PROCESSES})")
+    parser.add_argument('--output', default=DEFAULT_OUTPUT,
+                        help=f"file JSON dei risultati (default: {DEFAULT_OUTPUT})")
+    parser.add_argument('--baseline',
+                        help="risultati JSON di riferimento con cui confrontare l'esecuzione")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="rallentamento ammesso rispetto alla baseline (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    processes = [int(count) for count in args.processes.split(',') if count.strip()]
+    results = {
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'sizes': {},
+    }
+
+    for size in sizes:
+        print(f"→ {size} utenti...")
+        results['sizes'][str(size)] = stages = run_size(size, args.max_write_users, args.page_size, processes)
+        for name, data in stages.items():
+            print(f"  {name:<11} {data['seconds']:>9.3f}s  {data['per_second'] or 0:>12.0f}/s  ({data['count']})")
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"\n✓ Risultati salvati in {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\n✗ Regressioni rispetto alla baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("✓ Nessuna regressione rispetto alla baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
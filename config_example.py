@@ -6,7 +6,19 @@ NON committare config.py su GitHub!
 
 # Configurazione Active Directory
 AD_SERVER = "dc.tuaazienda.local"  # Modifica con il tuo server AD
+# Con più domain controller usa una lista: failover automatico, preferenza per i DC
+# che rispondono più velocemente e carico distribuito tra quelli comparabili
+# AD_SERVER = ["dc1.tuaazienda.local", "dc2.tuaazienda.local"]
 DOMAIN = "TUODOMINIO"              # Modifica con il tuo dominio
+BASE_DN = "DC=tuaazienda,DC=local" # Base DN usato per "Tutte le sedi"
+
+# Timeout (secondi) verso il domain controller
+CONNECT_TIMEOUT = 5    # apertura connessione
+RECEIVE_TIMEOUT = 30   # attesa risposta LDAP
+
+# Cartella dei profili utente in cui distribuire le firme
+# (es. "C:\\Users" oppure una share "\\\\fileserver\\profili$")
+PROFILES_ROOT = "C:\\Users"
 
 # Configurazione sedi (modifica con le tue OU)
 SEDI = {
@@ -20,6 +32,33 @@ SEDI = {
     },
     # Aggiungi altre sedi...
 }
+# Ogni sede può personalizzare la firma con le chiavi opzionali:
+#   'company_info': {...}            valori che sostituiscono quelli di COMPANY_INFO
+#   'template_dir': 'templates/...'  cartella con firma.htm / firma.txt della sede
+#   'reparti': {'Vendite': {'company_info': {...}, 'template_dir': '...'}}
+#                                    varianti per il campo department di AD
+
+# Firma predefinita di Outlook
+OFFICE_VERSION = '16.0'  # 16.0 = Office 2016/2019/2021/365
+SET_DEFAULT_SIGNATURE = True  # scrive nel registro dell'utente che esegue lo script
+REG_FILE = None  # es. r'\\server\netlogon\firma.reg': un file .reg per tutti gli utenti
+DEFAULTS_MANIFEST = None  # es. 'firma_predefinita.json' per Intune / script
+
+# Campo {{groups}} dei template: solo i gruppi il cui nome inizia così ('' = tutti)
+GROUP_PREFIX = ''
+
+# Filtri della ricerca utenti
+EXCLUDE_DISABLED = True  # ignora gli account disabilitati
+EXCLUDED_OUS = [
+    # 'OU=Dismessi,OU=Client,DC=tuaazienda,DC=local',
+]
+
+# Immagini della firma, usate nei template con {{asset.<nome>}}
+# (percorsi relativi alla cartella dello script)
+ASSETS = {
+    # 'logo': 'assets/logo.png',
+}
+ASSET_MODE = 'inline'  # 'inline': data URI nella firma, 'files': file collegati accanto alla firma
 
 # Informazioni aziendali per la firma
 COMPANY_INFO = {
@@ -5,429 +5,3855 @@ Permette di selezionare utenti specifici e aggiornare le loro firme Outlook
 
 import os
 import sys
+import re
+import io
+import copy
+import html
+import errno
+import importlib
+import json
+import asyncio
+import sqlite3
+import tarfile
+import zipfile
+import base64
+import hashlib
+import operator
+import mimetypes
+import shutil
+import itertools
+import argparse
+import time
+import queue
+import threading
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from contextlib import contextmanager, redirect_stdout
+from dataclasses import dataclass
 from pathlib import Path
 from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote, urlsplit
 
 try:
-    from ldap3 import Server, Connection, ALL, SUBTREE
+    from ldap3 import Server, Connection, ALL, NONE, SUBTREE
+    from ldap3.core.exceptions import LDAPException, LDAPCommunicationError
+    from ldap3.utils.conv import escape_filter_chars
 except ImportError:
     print("ERRORE: Modulo ldap3 non trovato. Installa con: pip install ldap3")
     sys.exit(1)
 
 
+# Campi utente e attributo AD da cui vengono letti (nell'ordine usato anche dallo snapshot locale)
+FIELD_ATTRIBUTES = (
+    ('username', 'sAMAccountName'),
+    ('display_name', 'displayName'),
+    ('first_name', 'givenName'),
+    ('last_name', 'sn'),
+    ('title', 'title'),
+    ('email', 'mail'),
+    ('phone', 'telephoneNumber'),
+    ('mobile', 'mobile'),
+    ('department', 'department'),
+    ('company', 'company'),
+    ('office', 'physicalDeliveryOfficeName'),
+)
+USER_FIELDS = ('dn',) + tuple(field for field, _ in FIELD_ATTRIBUTES) + ('usn_changed',)
+
+# Attributi AD letti per ogni utente
+USER_ATTRIBUTES = [attribute for _, attribute in FIELD_ATTRIBUTES] + ['uSNChanged']
+
+# Attributi richiesti anche quando la ricerca si limita a quelli dei template:
+# cartella della firma, email, elenco utenti e sincronizzazione incrementale
+REQUIRED_ATTRIBUTES = ('sAMAccountName', 'mail', 'displayName', 'uSNChanged')
+
+# Filtri LDAP: account utente (sAMAccountType è indicizzato, più selettivo di objectClass)
+# e bit ACCOUNTDISABLE (0x2) di userAccountControl con la regola LDAP_MATCHING_RULE_BIT_AND
+USER_ACCOUNT_FILTER = '(sAMAccountType=805306368)'
+DISABLED_ACCOUNT_FILTER = '(userAccountControl:1.2.840.113556.1.4.803:=2)'
+SEARCH_TEXT_ATTRIBUTES = ('sAMAccountName', 'displayName', 'givenName', 'sn', 'mail')
+
+
+# Campi ricavati da oggetti collegati all'utente, con l'oggetto da cui provengono:
+# responsabile (attributo manager), gruppi (memberOf) e OU che contiene l'utente
+ENRICHMENT_FIELDS = {
+    'manager_name': 'manager',
+    'manager_email': 'manager',
+    'manager_title': 'manager',
+    'groups': 'memberOf',
+    'ou_name': 'ou',
+    'ou_street': 'ou',
+    'ou_postal_code': 'ou',
+    'ou_city': 'ou',
+    'ou_address': 'ou',
+}
+
+
+def _first_value(values):
+    """Primo valore (decodificato) di un attributo raw ldap3, '' se assente"""
+    if not values:
+        return ''
+    value = values[0]
+    if value.__class__ is bytes:
+        value = value.decode('utf-8', 'replace')
+    return value.strip()
+
+
+class ADUser:
+    """
+    Utente AD normalizzato
+
+    Record compatto (__slots__) costruito direttamente dagli attributi raw
+    della risposta LDAP. Supporta anche l'accesso come dizionario
+    (user['email']), usato da template, snapshot e menu.
+    """
+
+    __slots__ = USER_FIELDS + ('extra',)
+
+    def __init__(self, dn='', username='', display_name='', first_name='', last_name='', title='',
+                 email='', phone='', mobile='', department='', company='', office='', usn_changed=0,
+                 extra=None):
+        self.dn = dn
+        self.username = username
+        self.display_name = display_name
+        self.first_name = first_name
+        self.last_name = last_name
+        self.title = title
+        self.email = email
+        self.phone = phone
+        self.mobile = mobile
+        self.department = department
+        self.company = company
+        self.office = office
+        self.usn_changed = usn_changed
+        self.extra = extra  # campi ENRICHMENT_FIELDS, se risolti
+
+    @classmethod
+    def from_raw_attributes(cls, dn, raw_attributes, default_company=''):
+        """
+        Costruisce l'utente dal dizionario 'raw_attributes' di ldap3
+
+        Gli attributi raw sono sempre liste di bytes, anche senza schema:
+        per i campi a valore singolo viene preso il primo valore.
+        """
+        get = raw_attributes.get
+        usn = _first_value(get('uSNChanged'))
+        user = cls(dn, *[_first_value(get(attribute)) for _, attribute in FIELD_ATTRIBUTES],
+                   int(usn) if usn else 0)
+        if not user.company:
+            user.company = default_company
+        return user
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __getattr__(self, name):
+        # Chiamato solo per i nomi che non sono slot: campi di arricchimento ('' se non risolti)
+        if name in ENRICHMENT_FIELDS:
+            return (self.extra or {}).get(name, '')
+        raise AttributeError(name)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return USER_FIELDS + tuple(self.extra) if self.extra else USER_FIELDS
+
+    def astuple(self):
+        return tuple(getattr(self, field) for field in USER_FIELDS)
+
+    def __eq__(self, other):
+        return isinstance(other, ADUser) and self.astuple() == other.astuple()
+
+    def __hash__(self):
+        return hash(self.astuple())
+
+    def __repr__(self):
+        return f"ADUser({self.username!r}, {self.email!r})"
+
+# DN letti con una sola ricerca (|(distinguishedName=...)...) durante l'arricchimento
+DEFAULT_LOOKUP_CHUNK = 100
+
+
+def parent_dn(dn):
+    """DN del contenitore di un oggetto (senza il primo RDN)"""
+    parts = re.split(r'(?<!\\),', dn, maxsplit=1)
+    return parts[1] if len(parts) > 1 else ''
+
+
+def domain_of(dn):
+    """Parte DC=... di un DN (naming context da usare come base di ricerca)"""
+    parts = re.split(r'(?<!\\),', dn)
+    return ','.join(part for part in parts if part.strip().upper().startswith('DC='))
+
+
+def _rdn_value(dn):
+    """Valore del primo RDN (es. 'Vendite' da 'CN=Vendite,OU=Gruppi,...')"""
+    first = re.split(r'(?<!\\),', dn, maxsplit=1)[0]
+    return first.split('=', 1)[-1].replace('\\', '')
+
+
+class DirectoryEnricher:
+    """
+    Risolve i campi ENRICHMENT_FIELDS con ricerche a blocchi
+
+    Per ogni pagina di utenti raccoglie tutti i DN referenziati (manager,
+    memberOf, OU che li contengono) e li legge con poche ricerche
+    (|(distinguishedName=dn1)(distinguishedName=dn2)...), invece di una
+    ricerca per utente. I DN già letti restano in cache per tutta la sessione.
+    """
+
+    LOOKUP_ATTRIBUTES = ['displayName', 'cn', 'mail', 'title', 'street', 'postalCode', 'l', 'st']
+
+    def __init__(self, sources, group_prefix='', chunk_size=DEFAULT_LOOKUP_CHUNK, metrics=None):
+        """
+        Args:
+            sources: Oggetti da risolvere: 'manager', 'memberOf', 'ou'
+            group_prefix: Solo i gruppi il cui nome inizia così ('' = tutti)
+            chunk_size: Numero massimo di DN per ricerca
+            metrics: Metrics in cui registrare le ricerche (fase 'enrich_lookup')
+        """
+        self.sources = set(sources)
+        self.group_prefix = group_prefix.lower()
+        self.chunk_size = chunk_size
+        self.metrics = metrics
+        self.lookups = 0
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def user_attributes(self):
+        """Attributi aggiuntivi da chiedere per ogni utente"""
+        return [source for source in ('manager', 'memberOf') if source in self.sources]
+
+    def enrich(self, conn, entries):
+        """
+        Imposta user.extra per una pagina di utenti
+
+        Args:
+            conn: Connessione ldap3
+            entries: Lista di tuple (ADUser, raw_attributes della entry)
+        """
+        wanted = set()
+        for user, raw in entries:
+            manager_dn = _first_value(raw.get('manager'))
+            if manager_dn and 'manager' in self.sources:
+                wanted.add(manager_dn)
+            if 'memberOf' in self.sources:
+                wanted.update(value.decode('utf-8', 'replace') for value in raw.get('memberOf') or [])
+            if 'ou' in self.sources:
+                dn = parent_dn(user['dn'])
+                while dn and not dn.upper().startswith('DC='):
+                    wanted.add(dn)
+                    dn = parent_dn(dn)
+        objects = self._lookup(conn, wanted)
+
+        for user, raw in entries:
+            extra = {}
+            if 'manager' in self.sources:
+                manager = objects.get(_first_value(raw.get('manager')).lower()) or {}
+                extra['manager_name'] = clean_display_name(manager.get('displayName') or manager.get('cn', ''))
+                extra['manager_email'] = manager.get('mail', '')
+                extra['manager_title'] = manager.get('title', '')
+            if 'memberOf' in self.sources:
+                names = []
+                for value in raw.get('memberOf') or []:
+                    group_dn = value.decode('utf-8', 'replace')
+                    group = objects.get(group_dn.lower()) or {}
+                    name = group.get('displayName') or group.get('cn') or _rdn_value(group_dn)
+                    if name.lower().startswith(self.group_prefix):
+                        names.append(name)
+                extra['groups'] = ', '.join(sorted(names))
+            if 'ou' in self.sources:
+                extra.update(self._ou_fields(user['dn'], objects))
+            user.extra = extra
+
+    def _ou_fields(self, dn, objects):
+        """Nome della OU dell'utente e indirizzo della OU più vicina che ne ha uno"""
+        ou_dn = parent_dn(dn)
+        fields = {'ou_name': _rdn_value(ou_dn) if ou_dn else ''}
+        while ou_dn and not ou_dn.upper().startswith('DC='):
+            ou = objects.get(ou_dn.lower()) or {}
+            if ou.get('street'):
+                city = ' '.join(part for part in (ou.get('postalCode', ''), ou.get('l', '')) if part)
+                if ou.get('st'):
+                    city = f"{city} ({ou['st']})"
+                fields.update(ou_street=ou['street'], ou_postal_code=ou.get('postalCode', ''),
+                              ou_city=ou.get('l', ''),
+                              ou_address=', '.join(part for part in (ou['street'], city) if part))
+                break
+            ou_dn = parent_dn(ou_dn)
+        return fields
+
+    def _lookup(self, conn, dns):
+        """
+        Legge gli oggetti indicati, usando la cache
+
+        Returns:
+            Dizionario {dn minuscolo: {attributo: valore}} ({} per i DN non trovati)
+        """
+        with self._lock:
+            missing = sorted({dn for dn in dns if dn.lower() not in self._cache})
+
+        # Una ricerca per blocco di DN, sulla partizione (DC=...) di appartenenza
+        by_domain = {}
+        for dn in missing:
+            by_domain.setdefault(domain_of(dn), []).append(dn)
+        found = {dn.lower(): {} for dn in missing}
+        for domain, domain_dns in by_domain.items():
+            for start in range(0, len(domain_dns), self.chunk_size):
+                chunk = domain_dns[start:start + self.chunk_size]
+                terms = ''.join(f"(distinguishedName={escape_filter_chars(dn)})" for dn in chunk)
+                t0 = time.perf_counter()
+                conn.search(domain, f"(|{terms})", SUBTREE, attributes=self.LOOKUP_ATTRIBUTES)
+                for entry in conn.response or []:
+                    if entry.get('type') == 'searchResEntry':
+                        found[entry['dn'].lower()] = {name: _first_value(values)
+                                                      for name, values in entry['raw_attributes'].items()}
+                with self._lock:
+                    self.lookups += 1
+                if self.metrics is not None:
+                    self.metrics.observe('enrich_lookup', time.perf_counter() - t0, len(chunk))
+
+        with self._lock:
+            self._cache.update(found)
+            return {dn.lower(): self._cache.get(dn.lower(), {}) for dn in dns}
+
+
+# Dimensione pagina per le ricerche paged results (MaxPageSize di AD: 1000)
+DEFAULT_PAGE_SIZE = 1000
+PAGED_RESULTS_OID = '1.2.840.113556.1.4.319'
+
+# Timeout (secondi) verso il domain controller
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_RECEIVE_TIMEOUT = 30
+
+# Secondi per cui un DC irraggiungibile viene escluso prima di riprovarlo
+DC_RETRY_AFTER = 60
+# DC più lenti di così rispetto al più veloce non entrano nella rotazione delle connessioni parallele
+DC_SLOW_FACTOR = 3
+
+
+class DomainControllerPool:
+    """
+    Elenco di domain controller con stato di salute
+
+    I DC che non rispondono vengono messi in fondo alla lista per
+    DC_RETRY_AFTER secondi. Quelli disponibili sono ordinati per tempo di
+    collegamento (media mobile; i DC mai misurati vengono provati per primi);
+    per le connessioni parallele la scelta ruota (round robin) tra i DC non
+    più lenti di DC_SLOW_FACTOR volte il più veloce.
+    """
+
+    def __init__(self, hosts, retry_after=DC_RETRY_AFTER):
+        self.hosts = [host for host in hosts if host]
+        if not self.hosts:
+            raise ValueError("Nessun domain controller configurato")
+        self.retry_after = retry_after
+        self._down_until = {}
+        self.latency = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def ordered(self, rotate=False):
+        """
+        DC nell'ordine in cui provarli: prima i disponibili, poi quelli in errore
+
+        Args:
+            rotate: Parte dal DC successivo a quello della chiamata precedente
+        """
+        now = time.monotonic()
+        with self._lock:
+            healthy = [host for host in self.hosts if self._down_until.get(host, 0) <= now]
+            down = [host for host in self.hosts if host not in healthy]
+            healthy.sort(key=lambda host: self.latency.get(host, 0.0))
+            if rotate and healthy:
+                limit = self.latency.get(healthy[0], 0.0) * DC_SLOW_FACTOR
+                fast = [host for host in healthy if self.latency.get(host, 0.0) <= limit]
+                start = self._next % len(fast)
+                self._next += 1
+                healthy = fast[start:] + fast[:start] + healthy[len(fast):]
+        return healthy + down
+
+    def mark_failed(self, host):
+        with self._lock:
+            self._down_until[host] = time.monotonic() + self.retry_after
+        print(f"  ⚠ Domain controller {host} non disponibile per {self.retry_after}s")
+
+    def mark_ok(self, host, latency):
+        with self._lock:
+            self._down_until.pop(host, None)
+            previous = self.latency.get(host)
+            self.latency[host] = latency if previous is None else 0.7 * previous + 0.3 * latency
+
+
+# Connessioni LDAP contemporanee per le ricerche su più OU
+DEFAULT_POOL_SIZE = 4
+
+# File di stato locale (high-water mark uSNChanged per DC/OU)
+STATE_FILE = '.ad_signature_state.json'
+
+
+class StateStore:
+    """Stato persistente in un file JSON locale, diviso in sezioni"""
+
+    def __init__(self, path=STATE_FILE):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        try:
+            self._data = json.loads(self.path.read_text(encoding='utf-8'))
+        except FileNotFoundError:
+            self._data = {}
+        except (OSError, ValueError) as e:
+            print(f"⚠ File di stato {self.path} non leggibile, riparto da zero: {e}")
+            self._data = {}
+
+    def get(self, section, key, default=None):
+        with self._lock:
+            return self._data.get(section, {}).get(key, default)
+
+    def set(self, section, key, value):
+        with self._lock:
+            self._data.setdefault(section, {})[key] = value
+
+    def save(self):
+        """Scrive lo stato su disco in modo atomico"""
+        with self._lock:
+            tmp_path = self.path.with_name(self.path.name + '.tmp')
+            tmp_path.write_text(json.dumps(self._data, indent=2, sort_keys=True), encoding='utf-8')
+            os.replace(tmp_path, self.path)
+
+
+class LDAPConnectionPool:
+    """Pool limitato di connessioni ldap3 già autenticate, condivise tra thread"""
+
+    def __init__(self, factory, max_size=DEFAULT_POOL_SIZE):
+        """
+        Args:
+            factory: Funzione senza argomenti che restituisce una connessione in bind
+            max_size: Numero massimo di connessioni aperte
+        """
+        self.factory = factory
+        self.max_size = max_size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._all = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """Prende in prestito una connessione, creandola se necessario"""
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self.factory()
+                with self._lock:
+                    self._all.append(conn)
+            try:
+                yield conn
+            except Exception:
+                # Connessione in stato incerto: non la rimettiamo nel pool
+                self._discard(conn)
+                raise
+            self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    def _discard(self, conn):
+        with self._lock:
+            if conn in self._all:
+                self._all.remove(conn)
+        try:
+            conn.unbind()
+        except Exception:
+            pass
+
+    def close(self):
+        """Chiude tutte le connessioni aperte dal pool"""
+        with self._lock:
+            for conn in self._all:
+                try:
+                    conn.unbind()
+                except Exception:
+                    pass
+            self._all.clear()
+
+
+# Template della firma: {{campo}}, {{company.chiave}} e sezioni {{#campo}}...{{/campo}}
+TEMPLATE_DIR = Path(__file__).resolve().parent / 'templates'
+HTML_TEMPLATE = 'firma.htm'
+TXT_TEMPLATE = 'firma.txt'
+
+# Suffissi rimossi dal displayName nelle firme
+DISPLAY_NAME_SUFFIXES = ('(..........)', '(Europoligrafico)', '(Carton Group)')
+
+_TEMPLATE_TAG = re.compile(r'\{\{\s*([#/]?)([\w.]+)\s*\}\}')
+
+
+def clean_display_name(display_name):
+    """Rimuove dal displayName i suffissi di gruppo/azienda"""
+    for suffix in DISPLAY_NAME_SUFFIXES:
+        if suffix in display_name:
+            display_name = display_name.replace(suffix, '')
+    return display_name.strip()
+
+
+class SignatureTemplate:
+    """
+    Template di firma precompilato
+
+    Il testo viene diviso una volta sola in segmenti statici e segnaposto:
+    il rendering di un utente calcola solo i valori dinamici e li unisce
+    ai segmenti statici con un unico join.
+    """
+
+    def __init__(self, text, escape_html=False, name='<template>'):
+        """
+        Args:
+            text: Testo del template
+            escape_html: Applica l'escape HTML ai valori inseriti
+            name: Nome del template (per i messaggi di errore)
+        """
+        self.name = name
+        self.escape_html = escape_html
+        self.version = hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]
+        self.fields = set()
+        self._segments, self._slots, _ = self._compile(text, 0, None)
+
+        # Campi da cui dipende il risultato, divisi tra utente e company.* (chiave della cache);
+        # gli asset.* sono fissi per tutta l'esecuzione e non entrano nella chiave
+        self.user_fields = tuple(sorted(f for f in self.fields if not f.startswith(('company.', 'asset.'))))
+        self.company_fields = tuple(sorted(f[len('company.'):] for f in self.fields if f.startswith('company.')))
+        self._user_key = operator.attrgetter(*self.user_fields) if self.user_fields else (lambda user: ())
+
+    def cache_key(self, user, company_info):
+        """Valori da cui dipende il risultato per user: template, campi utente e company.*"""
+        if user.__class__ is ADUser:
+            user_values = self._user_key(user)
+        else:
+            user_values = tuple(map(user.get, self.user_fields))
+        return (self.name, self.version, user_values, tuple(map(company_info.get, self.company_fields)))
+
+    @classmethod
+    def from_file(cls, path):
+        """Carica un template dal disco; l'escape HTML dipende dall'estensione"""
+        path = Path(path)
+        text = path.read_text(encoding='utf-8')
+        return cls(text, escape_html=path.suffix.lower() in ('.htm', '.html'), name=path.name)
+
+    def _compile(self, text, pos, section):
+        """
+        Compila il testo da pos fino alla chiusura di section (o alla fine)
+
+        Returns:
+            Tupla (segmenti, slot (indice, campo, corpo sezione), posizione finale)
+        """
+        segments = []
+        slots = []
+        while True:
+            match = _TEMPLATE_TAG.search(text, pos)
+            if match is None:
+                if section is not None:
+                    raise ValueError(f"{self.name}: sezione '{section}' non chiusa")
+                segments.append(text[pos:])
+                break
+
+            segments.append(text[pos:match.start()])
+            kind, field = match.groups()
+            pos = match.end()
+
+            if kind == '/':
+                if field != section:
+                    raise ValueError(f"{self.name}: chiusura '{field}' inattesa")
+                break
+
+            self.fields.add(field)
+            if kind == '#':
+                sub_segments, sub_slots, pos = self._compile(text, pos, field)
+                body = (sub_segments, sub_slots)
+            else:
+                body = None
+            slots.append((len(segments), field, body))
+            segments.append('')
+
+        return segments, slots, pos
+
+    def render(self, values):
+        """
+        Genera il testo della firma
+
+        Args:
+            values: Dizionario {segnaposto: valore}
+
+        Returns:
+            Stringa con il template compilato
+        """
+        return self._render(self._segments, self._slots, values)
+
+    def _render(self, segments, slots, values):
+        escape = _escape_html if self.escape_html else str
+        out = segments.copy()
+        for idx, field, body in slots:
+            value = values.get(field)
+            if not value:
+                continue
+            if body is None:
+                out[idx] = escape(value if value.__class__ is str else str(value))
+            else:
+                out[idx] = self._render(body[0], body[1], values)
+        return ''.join(out)
+
+
+# Firme generate tenute in memoria (0 per disattivare la cache)
+DEFAULT_RENDER_CACHE_SIZE = 4096
+
+
+class RenderCache:
+    """
+    Cache LRU limitata delle firme generate
+
+    La chiave comprende template, versione e valori dei soli campi usati dal
+    template: utenti con gli stessi dati (caselle condivise, nuove
+    generazioni nella stessa sessione, retry) non vengono rigenerati.
+    """
+
+    def __init__(self, max_size=DEFAULT_RENDER_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Firma in cache per key, None se assente"""
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            if len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        """Dizionario con dimensione, hit, miss e percentuale di hit"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._items),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+# Immagini delle firme (ASSETS): incorporate come data URI o file collegati accanto alla firma
+ASSET_MODES = ('inline', 'files')
+ASSETS_FOLDER = '.firme_assets'  # copia unica delle immagini in ogni cartella di destinazione
+
+
+class AssetStore:
+    """
+    Loghi e icone delle firme, letti e codificati una sola volta
+
+    Nei template l'immagine 'logo' si usa con {{asset.logo}} come src.
+    In modalità 'inline' il valore è un data URI base64, calcolato una volta
+    per immagine e riusato per tutte le firme. In modalità 'files' il valore
+    è il percorso relativo <cartella>/<file>: le immagini vengono scritte una
+    volta per cartella di destinazione (in ASSETS_FOLDER) e collegate con
+    hardlink nella cartella <nome firma>_files di ogni utente (copia se il
+    file system non supporta gli hardlink).
+    """
+
+    def __init__(self, assets, mode='inline', folder_name='firma_files'):
+        """
+        Args:
+            assets: Dizionario {nome: percorso del file immagine}
+            mode: Uno di ASSET_MODES
+            folder_name: Cartella delle immagini accanto al file .htm della firma
+        """
+        if mode not in ASSET_MODES:
+            raise ValueError(f"Modalità immagini non valida: {mode}")
+        self.mode = mode
+        self.folder_name = folder_name
+        self.files = {}  # nome file nella cartella delle immagini -> contenuto
+        self.values = {}  # 'asset.<nome>' -> valore per il template
+        self._roots = {}  # cartella di destinazione -> cartella delle copie uniche
+        self._lock = threading.Lock()
+
+        encoded = {}
+        for name, path in assets.items():
+            path = Path(path)
+            data = path.read_bytes()
+            filename = f"{name}{path.suffix.lower()}"
+            self.files[filename] = data
+            if mode == 'inline':
+                # Stessa immagine usata con più nomi: codificata una volta sola
+                digest = hashlib.sha256(data).hexdigest()
+                if digest not in encoded:
+                    mime = mimetypes.guess_type(path.name)[0] or 'application/octet-stream'
+                    encoded[digest] = f"data:{mime};base64,{base64.b64encode(data).decode('ascii')}"
+                self.values[f"asset.{name}"] = encoded[digest]
+            else:
+                self.values[f"asset.{name}"] = f"{folder_name}/{filename}"
+
+    def __bool__(self):
+        return bool(self.files)
+
+    @property
+    def linked(self):
+        """True se le immagini vanno scritte accanto alle firme (modalità 'files')"""
+        return self.mode == 'files' and bool(self.files)
+
+    def _masters(self, root):
+        """Cartella con la copia unica delle immagini per root, scritta alla prima richiesta"""
+        key = str(root)
+        with self._lock:
+            masters = self._roots.get(key)
+            if masters is None:
+                masters = Path(root) / ASSETS_FOLDER
+                masters.mkdir(parents=True, exist_ok=True)
+                for filename, data in self.files.items():
+                    target = masters / filename
+                    if not (target.is_file() and target.read_bytes() == data):
+                        tmp_path = target.with_name(target.name + '.tmp')
+                        tmp_path.write_bytes(data)
+                        os.replace(tmp_path, target)
+                self._roots[key] = masters
+            return masters
+
+    def link_into(self, root, folder):
+        """
+        Collega le immagini nella cartella <folder_name> dentro folder
+
+        Args:
+            root: Cartella di destinazione (profili o esportazione), che contiene ASSETS_FOLDER
+            folder: Cartella della firma di un utente
+
+        Returns:
+            Lista dei file creati (vuota se erano già presenti)
+        """
+        masters = self._masters(root)
+        target_folder = Path(folder) / self.folder_name
+        target_folder.mkdir(parents=True, exist_ok=True)
+        created = []
+        for filename, data in self.files.items():
+            master = masters / filename
+            target = target_folder / filename
+            if target.exists():
+                try:
+                    if os.path.samefile(master, target) or target.read_bytes() == data:
+                        continue
+                except OSError:
+                    pass
+                target.unlink()
+            try:
+                os.link(master, target)
+            except OSError:
+                shutil.copyfile(master, target)
+            created.append(target)
+        return created
+
+
+# Chiavi di una sede in SEDI che personalizzano la firma
+BRANDING_KEYS = ('company_info', 'template_dir', 'reparti')
+
+
+def _local_path(path):
+    """Percorso di template o immagini da config.py; i percorsi relativi partono dalla cartella dello script"""
+    if not path:
+        return None
+    return Path(__file__).resolve().parent / path
+
+
+@dataclass
+class Branding:
+    """Template e informazioni aziendali di una sede (o di un suo reparto)"""
+    name: str
+    company_info: dict
+    template_paths: dict  # nome template -> percorso del file
+    templates: dict  # nome template -> SignatureTemplate
+
+
+class BrandingRegistry:
+    """
+    Template e company_info per sede/reparto, scelti in base alla OU dell'utente
+
+    Tutti i template vengono compilati una sola volta alla creazione (lo
+    stesso file condiviso da più sedi viene compilato una volta). Ogni
+    utente viene instradato con un indice per suffisso del DN: si provano
+    solo i suffissi del DN dell'utente (uno per livello), indipendentemente
+    dal numero di sedi configurate; l'OU più specifica vince.
+    """
+
+    def __init__(self, default_dir, company_info, template_names=(HTML_TEMPLATE, TXT_TEMPLATE)):
+        self.template_names = tuple(template_names)
+        self._compiled = {}
+        self._routes = {}  # DN della OU (minuscolo) -> (Branding, {reparto minuscolo: Branding})
+        self.default = None
+        self.default = self.branding('default', default_dir, company_info)
+
+    def branding(self, name, template_dir, company_info, base=None):
+        """
+        Crea un Branding compilandone i template
+
+        I file assenti in template_dir vengono presi dal Branding base
+        (default: quello predefinito).
+        """
+        base = base or self.default
+        paths = {}
+        for template_name in self.template_names:
+            path = Path(template_dir) / template_name if template_dir else None
+            if path is None or not path.is_file():
+                if base is None:
+                    raise FileNotFoundError(f"Template non trovato: {path}")
+                path = base.template_paths[template_name]
+            paths[template_name] = path
+        templates = {}
+        for template_name, path in paths.items():
+            key = str(Path(path).resolve())
+            if key not in self._compiled:
+                self._compiled[key] = SignatureTemplate.from_file(path)
+            templates[template_name] = self._compiled[key]
+        return Branding(name, company_info, paths, templates)
+
+    def add_route(self, ou, branding, departments=None):
+        """Usa branding per gli utenti sotto ou (departments: {reparto: Branding})"""
+        self._routes[ou.lower()] = (branding, {dept.lower(): b for dept, b in (departments or {}).items()})
+
+    def route(self, user):
+        """Branding dell'utente: OU più specifica configurata, poi eventuale reparto"""
+        dn = user['dn'].lower()
+        pos = 0
+        while True:
+            entry = self._routes.get(dn[pos:])
+            if entry is not None:
+                branding, departments = entry
+                if departments:
+                    return departments.get(user['department'].lower(), branding)
+                return branding
+            pos = dn.find(',', pos) + 1
+            if not pos:
+                return self.default
+
+    def brandings(self):
+        """Tutti i Branding distinti, il predefinito per primo"""
+        result = {id(self.default): self.default}
+        for branding, departments in self._routes.values():
+            result.setdefault(id(branding), branding)
+            for department_branding in departments.values():
+                result.setdefault(id(department_branding), department_branding)
+        return list(result.values())
+
+    @classmethod
+    def from_settings(cls, settings, default_dir, company_info):
+        """
+        Registro dalle chiavi 'company_info', 'template_dir' e 'reparti' di SEDI
+
+        Returns:
+            BrandingRegistry, oppure None se nessuna sede personalizza la firma
+        """
+        sedi = settings['SEDI'].values()
+        if not any(key in sede for sede in sedi for key in BRANDING_KEYS):
+            return None
+        registry = cls(default_dir, company_info)
+
+        def make(name, options, base):
+            if not any(key in options for key in ('company_info', 'template_dir')):
+                return base
+            return registry.branding(name, _local_path(options.get('template_dir')),
+                                     {**base.company_info, **options.get('company_info', {})}, base)
+
+        for sede in sedi:
+            branding = make(sede['nome'], sede, registry.default)
+            departments = {department: make(f"{sede['nome']} / {department}", options, branding)
+                           for department, options in sede.get('reparti', {}).items()}
+            registry.add_route(sede['ou'], branding, departments)
+        return registry
+
+
+def _escape_html(value):
+    """html.escape() con scorciatoia per i valori senza caratteri speciali"""
+    if '&' in value or '<' in value or '>' in value or '"' in value or "'" in value:
+        return html.escape(value)
+    return value
+
+
+# Snapshot locale degli utenti (rendering senza interrogare AD)
+SNAPSHOT_FILE = '.ad_users_snapshot.sqlite'
+DEFAULT_SNAPSHOT_TTL = 24 * 3600  # secondi
+
+
+def is_under(dn, search_base):
+    """True se il DN è contenuto (direttamente o no) nella Base DN"""
+    dn = dn.lower()
+    search_base = search_base.lower()
+    return dn == search_base or dn.endswith(',' + search_base)
+
+
+class UserSnapshot:
+    """
+    Copia locale degli utenti letti da AD in un database SQLite
+
+    Permette di rigenerare le firme (es. dopo una modifica ai template)
+    senza collegarsi ad AD. Per ogni Base DN letta per intero viene salvata
+    la data dell'ultimo aggiornamento: dopo ttl secondi lo snapshot di
+    quella OU è considerato scaduto. I campi ENRICHMENT_FIELDS (user.extra)
+    sono salvati in JSON nella colonna extra.
+    """
+
+    def __init__(self, path=SNAPSHOT_FILE, ttl=DEFAULT_SNAPSHOT_TTL):
+        self.path = Path(path)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        columns = ', '.join(f"{field} {'INTEGER' if field == 'usn_changed' else 'TEXT'}" for field in USER_FIELDS[1:])
+        with self._db:
+            self._db.execute(f"CREATE TABLE IF NOT EXISTS users (dn TEXT PRIMARY KEY, {columns}, extra TEXT)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS refreshed (base_dn TEXT PRIMARY KEY, at REAL)")
+            # Snapshot creati prima della colonna extra
+            if 'extra' not in {row[1] for row in self._db.execute("PRAGMA table_info(users)")}:
+                self._db.execute("ALTER TABLE users ADD COLUMN extra TEXT")
+
+    def is_fresh(self, search_base):
+        """True se la Base DN (o una OU che la contiene) è stata letta da AD negli ultimi ttl secondi"""
+        with self._lock:
+            rows = self._db.execute("SELECT base_dn, at FROM refreshed").fetchall()
+        now = time.time()
+        return any(is_under(search_base, base) and now - at <= self.ttl for base, at in rows)
+
+    def refresh(self, search_base, users):
+        """Sostituisce gli utenti di una Base DN con il risultato di una ricerca completa"""
+        suffix = ',' + search_base.lower()
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM users WHERE lower(substr(dn, -?)) = ?", (len(suffix), suffix))
+            self._insert(users)
+            self._db.execute("INSERT OR REPLACE INTO refreshed (base_dn, at) VALUES (?, ?)",
+                             (search_base.lower(), time.time()))
+
+    def merge(self, users):
+        """Aggiorna solo gli utenti indicati (ricerche filtrate, sincronizzazione incrementale)"""
+        with self._lock, self._db:
+            self._insert(users)
+
+    def _insert(self, users):
+        def rows():
+            for user in users:
+                extra = user.get('extra')
+                yield (*[user[field] for field in USER_FIELDS], json.dumps(extra) if extra else None)
+
+        placeholders = ', '.join('?' * (len(USER_FIELDS) + 1))
+        self._db.executemany(
+            f"INSERT OR REPLACE INTO users ({', '.join(USER_FIELDS)}, extra) VALUES ({placeholders})", rows()
+        )
+
+    def iter_users(self, search_bases=None, search_query=None, batch_size=DEFAULT_PAGE_SIZE):
+        """
+        Legge gli utenti dallo snapshot, a blocchi di batch_size righe
+
+        Args:
+            search_bases: Lista di Base DN: solo gli utenti contenuti in queste OU
+            search_query: Testo da cercare in username, nome o email
+
+        Yields:
+            ADUser
+        """
+        query = (search_query or '').lower()
+        with self._lock:
+            cursor = self._db.execute(f"SELECT {', '.join(USER_FIELDS)}, extra FROM users ORDER BY dn")
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                user = UserStore._user(row)
+                if search_bases and not any(is_under(user['dn'], base) for base in search_bases):
+                    continue
+                if query and not any(query in user[field].lower() for field in ('username', 'display_name', 'email')):
+                    continue
+                yield user
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class UserStore:
+    """
+    Elenco di utenti su disco, usabile come una lista (len, users[i], for, append)
+
+    I record stanno in un database SQLite temporaneo: in memoria resta solo
+    la pagina richiesta, anche con ricerche sull'intero dominio. Gli indici
+    su username ed email (minuscoli) vengono creati alla prima ricerca per
+    prefisso, dopo il caricamento.
+    """
+
+    def __init__(self, users=(), path=''):
+        """
+        Args:
+            users: Utenti iniziali
+            path: File del database ('' = file temporaneo eliminato alla chiusura)
+        """
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._count = 0
+        self._indexed = False
+        columns = ', '.join(f"{field} {'INTEGER' if field == 'usn_changed' else 'TEXT'}" for field in USER_FIELDS)
+        with self._db:
+            self._db.execute("DROP TABLE IF EXISTS users")
+            self._db.execute(f"CREATE TABLE users (pos INTEGER PRIMARY KEY, {columns}, extra TEXT, "
+                             "username_key TEXT, email_key TEXT)")
+        self.extend(users)
+
+    def append(self, user):
+        self.extend((user,))
+
+    def extend(self, users):
+        """Aggiunge utenti in coda, a blocchi in un'unica transazione"""
+        placeholders = ', '.join('?' * (len(USER_FIELDS) + 4))
+        sql = f"INSERT INTO users VALUES ({placeholders})"
+        with self._lock, self._db:
+            batch = []
+            for user in users:
+                self._count += 1
+                extra = user.get('extra')
+                batch.append((self._count, *[user[field] for field in USER_FIELDS],
+                              json.dumps(extra) if extra else None,
+                              user['username'].lower(), user['email'].lower()))
+                if len(batch) >= DEFAULT_PAGE_SIZE:
+                    self._db.executemany(sql, batch)
+                    batch = []
+            if batch:
+                self._db.executemany(sql, batch)
+
+    def __len__(self):
+        return self._count
+
+    def _select(self, where, params=(), limit=-1):
+        with self._lock:
+            rows = self._db.execute(f"SELECT pos, {', '.join(USER_FIELDS)}, extra FROM users WHERE {where} "
+                                    "ORDER BY pos LIMIT ?", (*params, limit)).fetchall()
+        return [(row[0], self._user(row[1:])) for row in rows]
+
+    @staticmethod
+    def _user(row):
+        """ADUser da una riga (campi di USER_FIELDS + extra in JSON)"""
+        return ADUser(*row[:-1], extra=json.loads(row[-1]) if row[-1] else None)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        return self._select("pos = ?", (index + 1,))[0][1]
+
+    def __iter__(self):
+        with self._lock:
+            cursor = self._db.execute(f"SELECT {', '.join(USER_FIELDS)}, extra FROM users ORDER BY pos")
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(DEFAULT_PAGE_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield self._user(row)
+
+    def page(self, number, size):
+        """Pagina number (da 1) di size utenti, come lista di (posizione, ADUser)"""
+        start = (number - 1) * size
+        return self._select("pos > ? AND pos <= ?", (start, start + size))
+
+    def find(self, prefix, limit=20):
+        """
+        Utenti il cui username o email inizia con prefix (senza distinzione maiuscole)
+
+        Returns:
+            Lista di (posizione, ADUser), al massimo limit
+        """
+        with self._lock:
+            if not self._indexed:
+                with self._db:
+                    self._db.execute("CREATE INDEX IF NOT EXISTS users_username ON users (username_key)")
+                    self._db.execute("CREATE INDEX IF NOT EXISTS users_email ON users (email_key)")
+                self._indexed = True
+        # Intervallo [prefix, prefix + U+FFFF): la ricerca usa gli indici invece di LIKE
+        low = prefix.lower()
+        high = low + '\uffff'
+        return self._select("(username_key >= ? AND username_key < ?) OR (email_key >= ? AND email_key < ?)",
+                            (low, high, low, high), limit)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def update_snapshot(snapshot, users, search_bases, complete):
+    """
+    Salva nello snapshot il risultato di una ricerca
+
+    Args:
+        snapshot: UserSnapshot
+        users: Utenti trovati
+        search_bases: Base DN interrogate
+        complete: True se la ricerca era senza filtri (gli utenti assenti vanno rimossi)
+    """
+    if not complete:
+        snapshot.merge(users)
+        return
+    for search_base in search_bases:
+        snapshot.refresh(search_base, [user for user in users if is_under(user['dn'], search_base)])
+
+
+# Cartella dei profili utente e manifest degli hash delle firme scritte
+PROFILES_ROOT = "C:\\Users"
+MANIFEST_FILE = '.firme_manifest.json'
+
+# Firma predefinita di Outlook: chiave di registro per versione di Office (HKEY_CURRENT_USER)
+DEFAULT_OFFICE_VERSION = '16.0'
+MAIL_SETTINGS_KEY = r"Software\Microsoft\Office\{version}\Common\MailSettings"
+
+
+def content_hash(content):
+    """Hash SHA-256 del contenuto di una firma"""
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class SignatureManifest:
+    """
+    Hash dei file firma già scritti sotto una cartella di output
+
+    Permette di saltare le firme invariate senza aprire il file remoto
+    (e senza cambiarne la data di modifica, che in Outlook fa ripartire
+    la sincronizzazione delle firme roaming).
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.path = self.root / MANIFEST_FILE
+        self._lock = threading.Lock()
+        self._dirty = False
+        try:
+            self._hashes = json.loads(self.path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            self._hashes = {}
+
+    def is_unchanged(self, key, digest):
+        with self._lock:
+            return self._hashes.get(key) == digest
+
+    def update(self, key, digest):
+        with self._lock:
+            self._hashes[key] = digest
+            self._dirty = True
+
+    def save(self):
+        """Scrive il manifest su disco, solo se modificato"""
+        with self._lock:
+            if not self._dirty:
+                return
+            self.root.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(self.path.name + '.tmp')
+            tmp_path.write_text(json.dumps(self._hashes, sort_keys=True), encoding='utf-8')
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+
+
+# Configurazione predefinita (sovrascrivibile con config.py, vedi config_example.py)
+DEFAULT_SETTINGS = {
+    'AD_SERVER': "adds.google.com",
+    'DOMAIN': "GOOGLE",
+    'BASE_DN': "DC=adds,DC=GOOGLE,DC=com",
+    'SEDI': {
+        '1': {'nome': 'Italy', 'ou': 'OU=Treviso,OU=rIT,OU=Client,DC=adds,DC=google,DC=com'},
+        '2': {'nome': 'Roma', 'ou': 'OU=Perugia,OU=rIT,OU=Client,DC=adds,DC=google,DC=com'},
+        '3': {'nome': 'Spain', 'ou': 'OU=Verona,OU=rIT,OU=Client,DC=adds,DC=google,DC=com'},
+        '4': {'nome': 'Germania', 'ou': 'OU=rDE,OU=Client,DC=adds,DC=google,DC=com'},
+    },
+    'COMPANY_INFO': {
+        'nome': 'Google',
+        'indirizzo': 'Address',
+        'website': 'www.google.com',
+        'logo_url': 'https://www.google.com/logo.png',
+        'colore_primario': '#0066cc',
+        'colore_secondario': '#666666',
+        'disclaimer': 'Questo messaggio è confidenziale. Se non siete il destinatario, vi preghiamo di eliminarlo.'
+    },
+    'PROFILES_ROOT': PROFILES_ROOT,
+    'CONNECT_TIMEOUT': DEFAULT_CONNECT_TIMEOUT,
+    'RECEIVE_TIMEOUT': DEFAULT_RECEIVE_TIMEOUT,
+    'OFFICE_VERSION': DEFAULT_OFFICE_VERSION,
+    'SET_DEFAULT_SIGNATURE': True,  # scrive nel registro dell'utente che esegue lo script
+    'REG_FILE': None,
+    'DEFAULTS_MANIFEST': None,
+    'GROUP_PREFIX': '',
+    'EXCLUDE_DISABLED': True,
+    'EXCLUDED_OUS': [],
+    'ASSETS': {},
+    'ASSET_MODE': 'inline',
+}
+
+# Pagine di utenti in attesa tra ricerca e generazione nella pipeline asincrona
+DEFAULT_QUEUE_SIZE = 4
+
+# Distribuzione parallela delle firme
+DEFAULT_DEPLOY_WORKERS = 16
+DEFAULT_WRITES_PER_SERVER = 8
+DEFAULT_IO_RETRIES = 3
+DEFAULT_IO_BACKOFF = 0.5  # secondi, raddoppiati a ogni tentativo
+
+# Generazione delle firme su più processi (--processes): utenti per blocco inviato a un processo
+DEFAULT_RENDER_CHUNK = 500
+
+# Errori di I/O che su share SMB sono tipicamente temporanei
+TRANSIENT_ERRNOS = {errno.EAGAIN, errno.EBUSY, errno.EINTR, errno.EIO,
+                    errno.ETIMEDOUT, errno.ECONNRESET, errno.ECONNABORTED}
+TRANSIENT_WINERRORS = {32, 33, 53, 64, 121, 1231}  # file in uso, lock, rete non raggiungibile, timeout
+
+
+def is_transient_io_error(exc):
+    """True se l'errore di I/O può sparire riprovando"""
+    if isinstance(exc, (TimeoutError, ConnectionError, BlockingIOError, InterruptedError)):
+        return True
+    if getattr(exc, 'winerror', None) in TRANSIENT_WINERRORS:
+        return True
+    return exc.errno in TRANSIENT_ERRNOS
+
+
+def file_server_of(path):
+    """Nome del file server di un percorso UNC (\\\\server\\share), 'locale' altrimenti"""
+    path = str(path)
+    if path.startswith(('\\\\', '//')):
+        return re.split(r'[\\/]', path.lstrip('\\/'), maxsplit=1)[0].lower()
+    return 'locale'
+
+
+class WinregRegistry:
+    """Registro di Windows dell'utente corrente (HKEY_CURRENT_USER) tramite winreg"""
+
+    def __init__(self):
+        import winreg  # ImportError fuori da Windows
+        self._winreg = winreg
+
+    def set_values(self, key_path, values):
+        """Scrive valori stringa (REG_SZ) nella chiave, creandola se manca"""
+        winreg = self._winreg
+        with winreg.CreateKey(winreg.HKEY_CURRENT_USER, key_path) as key:
+            for name, value in values.items():
+                winreg.SetValueEx(key, name, 0, winreg.REG_SZ, value)
+
+
+class MemoryRegistry:
+    """Registro in memoria con la stessa interfaccia di WinregRegistry (test, sistemi non Windows)"""
+
+    def __init__(self):
+        self.keys = {}
+
+    def set_values(self, key_path, values):
+        self.keys.setdefault(key_path, {}).update(values)
+
+
+def default_registry():
+    """WinregRegistry su Windows, None dove il registro non è disponibile"""
+    try:
+        return WinregRegistry()
+    except ImportError:
+        return None
+
+
+def _reg_string(value):
+    """Valore stringa nel formato dei file .reg"""
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+# Esportazione in un unico archivio: formato scelto dall'estensione
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz')
+ARCHIVE_MANIFEST = 'manifest.json'
+
+
+def is_archive_path(path):
+    """True se il percorso indica un archivio (.zip, .tar, .tar.gz, .tgz) invece di una cartella"""
+    return str(path).lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+@dataclass
+class DeployResult:
+    """Esito della distribuzione della firma di un utente"""
+    username: str
+    ok: bool
+    folder: str = ''
+    written: int = 0
+    error: str = ''
+    elapsed: float = 0.0
+
+
+# Prefisso delle metriche nel formato Prometheus (textfile collector di node_exporter)
+METRICS_PREFIX = 'ad_signature'
+METRICS_FORMATS = ('jsonl', 'prometheus')
+
+
+class Metrics:
+    """
+    Tempi e contatori per fase (connect, search, render, deploy, save, write)
+
+    Per ogni fase registra numero di chiamate, tempo totale e massimo,
+    elementi elaborati, byte scritti ed errori. Thread-safe: le fasi di
+    scrittura vengono aggiornate dai thread di deploy_batch.
+    """
+
+    FIELDS = ('calls', 'seconds', 'max_seconds', 'items', 'bytes', 'errors')
+
+    def __init__(self):
+        self.started = time.time()
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds, items=1, nbytes=0, errors=0):
+        """Registra una chiamata di una fase"""
+        # Liste invece di dizionari: viene chiamato per ogni firma generata
+        with self._lock:
+            data = self._stages.get(stage)
+            if data is None:
+                data = self._stages[stage] = [0, 0.0, 0.0, 0, 0, 0]
+            data[0] += 1
+            data[1] += seconds
+            if seconds > data[2]:
+                data[2] = seconds
+            data[3] += items
+            data[4] += nbytes
+            data[5] += errors
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        Misura il blocco come una chiamata di stage
+
+        Il blocco può aggiornare 'items' e 'bytes' nel dizionario restituito;
+        un'eccezione viene contata come errore e rilanciata.
+        """
+        record = {'items': 1, 'bytes': 0}
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException:
+            self.observe(stage, time.perf_counter() - start, 0, 0, 1)
+            raise
+        self.observe(stage, time.perf_counter() - start, record['items'], record['bytes'])
+
+    def snapshot(self):
+        """Copia dei contatori: {fase: {calls, seconds, max_seconds, items, bytes, errors}}"""
+        with self._lock:
+            return {stage: {key: round(value, 6) if isinstance(value, float) else value
+                            for key, value in zip(self.FIELDS, data)}
+                    for stage, data in self._stages.items()}
+
+    def write_jsonl(self, path):
+        """Aggiunge al file una riga JSON per fase (storico delle esecuzioni)"""
+        timestamp = datetime.now().isoformat(timespec='seconds')
+        with open(path, 'a', encoding='utf-8') as f:
+            for stage, data in self.snapshot().items():
+                f.write(json.dumps({'time': timestamp, 'stage': stage, **data}) + '\n')
+
+    def prometheus_text(self):
+        """Metriche nel formato testuale di Prometheus"""
+        stages = self.snapshot()
+        lines = []
+        for field, kind, description in (
+            ('calls', 'counter', 'Chiamate per fase'),
+            ('seconds', 'counter', 'Tempo totale per fase in secondi'),
+            ('max_seconds', 'gauge', 'Chiamata più lenta per fase in secondi'),
+            ('items', 'counter', 'Elementi elaborati per fase'),
+            ('bytes', 'counter', 'Byte scritti per fase'),
+            ('errors', 'counter', 'Errori per fase'),
+        ):
+            name = f"{METRICS_PREFIX}_stage_{field}" + ('_total' if kind == 'counter' else '')
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for stage, data in stages.items():
+                lines.append(f'{name}{{stage="{stage}"}} {data[field]}')
+        lines.append(f"# HELP {METRICS_PREFIX}_last_run_timestamp_seconds Avvio dell'ultima esecuzione")
+        lines.append(f"# TYPE {METRICS_PREFIX}_last_run_timestamp_seconds gauge")
+        lines.append(f"{METRICS_PREFIX}_last_run_timestamp_seconds {self.started:.0f}")
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """
+        Scrive le metriche nel formato testuale di Prometheus
+
+        Il file viene sostituito in modo atomico, come richiesto dal
+        textfile collector di node_exporter.
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+    def export(self, path, fmt='jsonl'):
+        """Esporta le metriche in uno dei METRICS_FORMATS"""
+        if fmt == 'prometheus':
+            self.write_prometheus(path)
+        else:
+            self.write_jsonl(path)
+
+
+def template_values(user, company_info, assets=None):
+    """Valori dei segnaposto per un utente (campi utente + company.* + asset.*)"""
+    values = {f"company.{key}": value for key, value in company_info.items()}
+    if assets:
+        values.update(assets)
+    values.update(user)
+    values['display_name'] = clean_display_name(user['display_name'])
+    return values
+
+
+# Stato dei processi di render_parallel(), impostato da _init_render_worker()
+_worker_brandings = None
+_worker_assets = None
+
+
+def _init_render_worker(brandings, assets=None):
+    """
+    Compila i template di ogni branding
+
+    Args:
+        brandings: Lista di (percorso HTML, percorso TXT, company_info)
+        assets: Valori asset.* già codificati (AssetStore.values)
+    """
+    global _worker_brandings, _worker_assets
+    _worker_assets = assets
+    compiled = {}
+    for html_path, txt_path in {(html_path, txt_path) for html_path, txt_path, _ in brandings}:
+        compiled[html_path, txt_path] = (SignatureTemplate.from_file(html_path), SignatureTemplate.from_file(txt_path))
+    _worker_brandings = [compiled[html_path, txt_path] + (company_info,)
+                         for html_path, txt_path, company_info in brandings]
+
+
+def _render_chunk(records):
+    """
+    Genera HTML e TXT per un blocco di utenti in un processo del pool
+
+    Args:
+        records: Lista di tuple (campi USER_FIELDS..., extra, indice del branding)
+
+    Returns:
+        Tupla (lista di (html, txt) o messaggio di errore per utente, secondi impiegati)
+    """
+    start = time.perf_counter()
+    rendered = []
+    for record in records:
+        try:
+            html_template, txt_template, company_info = _worker_brandings[record[-1]]
+            values = template_values(ADUser(*record[:-2], extra=record[-2]), company_info, _worker_assets)
+            rendered.append((html_template.render(values), txt_template.render(values)))
+        except Exception as e:
+            rendered.append(str(e))
+    return rendered, time.perf_counter() - start
+
+
 class ADSignatureManager:
-    def __init__(self, ad_server, domain, base_dn, username, password):
+    def __init__(self, ad_server, domain, base_dn, username, password, state_file=STATE_FILE,
+                 profiles_root=PROFILES_ROOT, template_dir=TEMPLATE_DIR,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, receive_timeout=DEFAULT_RECEIVE_TIMEOUT,
+                 fetch_schema=False):
+        """
+        Inizializza la connessione ad Active Directory
+        
+        Args:
+            ad_server: Server AD (es. 'dc.azienda.local') o lista di domain controller
+            domain: Dominio (es. 'AZIENDA')
+            base_dn: Base DN (es. 'DC=azienda,DC=local')
+            username: Username AD con permessi di lettura
+            password: Password
+            state_file: File JSON per lo stato della sincronizzazione incrementale
+            profiles_root: Cartella che contiene i profili utente (es. C:\\Users o \\\\server\\profili$)
+            template_dir: Cartella con i template firma.htm / firma.txt
+            connect_timeout: Timeout (secondi) di apertura del socket verso il DC
+            receive_timeout: Timeout (secondi) di attesa di una risposta LDAP
+            fetch_schema: Scarica schema e info DSA al collegamento (lento, di solito non serve)
+        """
+        self.dc_pool = DomainControllerPool([ad_server] if isinstance(ad_server, str) else ad_server)
+        self.ad_server = self.dc_pool.hosts[0]  # DC in uso dopo connect_to_ad()
+        self.domain = domain
+        self.base_dn = base_dn
+        self.username = username
+        self.password = password
+        self.connection = None
+        self._bind_params = None
+        self._last_connect_error = None
+        self.connect_timeout = connect_timeout
+        self.receive_timeout = receive_timeout
+        self.fetch_schema = fetch_schema
+        self.state = StateStore(state_file)
+        self._pending_usn = {}
+        
+        # Attributi richiesti ad AD e OU (Base DN) i cui utenti vengono ignorati
+        self.search_attributes = USER_ATTRIBUTES
+        self.excluded_ous = []
+        
+        # Campi da oggetti collegati (responsabile, gruppi, OU): attivati dai template che li usano
+        self.enricher = None
+        self.group_prefix = ''
+        self._enricher_checked = False
+        self._enricher_lock = threading.Lock()
+        
+        # Tempi e contatori per fase; quiet disattiva i messaggi per singolo file/utente
+        self.metrics = Metrics()
+        self.quiet = False
+        
+        # Cartella radice dei profili utente per deploy_signature_to_user
+        self.profiles_root = profiles_root
+        self._manifests = {}
+        self._manifest_lock = threading.Lock()
+        self.write_stats = {'written': 0, 'skipped': 0, 'failed': 0, 'bytes': 0}
+        self._stats_lock = threading.Lock()
+        
+        # Scritture parallele: limite per file server e retry degli errori transitori
+        self.max_writes_per_server = DEFAULT_WRITES_PER_SERVER
+        self.io_retries = DEFAULT_IO_RETRIES
+        self.io_backoff = DEFAULT_IO_BACKOFF
+        self._server_slots = {}
+        
+        # Firma predefinita: una sola scrittura per batch, nel registro dell'operatore
+        # (registry, None per saltarla) oppure in un file .reg / manifest per gli utenti
+        self.office_version = DEFAULT_OFFICE_VERSION
+        self.registry = default_registry()
+        self.reg_file = None
+        self.defaults_manifest = None
+        
+        # Template della firma (caricati dal disco al primo utilizzo) e firme già generate
+        self.template_dir = template_dir
+        self._templates = {}
+        self.render_cache = RenderCache()
+        self.branding = None  # BrandingRegistry: template e company_info per sede
+        self.assets = None  # AssetStore: immagini {{asset.*}} dei template
+        
+        # Configurazione aziendale
+        self.company_info = {
+            'nome': 'La Tua Azienda S.r.l.',
+            'indirizzo': 'Via Roma 123, 20100 Milano (MI)',
+            'website': 'www.tuaazienda.it',
+            'logo_url': 'https://www.tuaazienda.it/logo.png',
+            'colore_primario': '#0066cc',
+            'colore_secondario': '#666666',
+            'disclaimer': 'Questo messaggio è confidenziale. Se non siete il destinatario, vi preghiamo di eliminarlo.'
+        }
+    
+    def _user_formats(self, host):
+        """Varianti del formato username da provare per il bind"""
+        return {
+            'domain': f"{self.domain}\\{self.username}",  # DOMAIN\username
+            'upn_server': f"{self.username}@{host}",  # username@server
+            'upn_domain': f"{self.username}@{self.domain}",  # username@DOMAIN
+            'plain': self.username  # username semplice
+        }
+
+    def _bind_candidates(self, host):
+        """
+        Combinazioni porta/formato username da provare su un DC, nell'ordine
+
+        La combinazione che ha funzionato l'ultima volta con questo server
+        (salvata nel file di stato) viene provata per prima.
+        """
+        candidates = [(389, False, name) for name in self._user_formats(host)]
+        candidates.append((636, True, 'domain'))  # LDAPS
+
+        cached = self.state.get('bind', host)
+        if cached:
+            key = (cached['port'], cached['use_ssl'], cached['format'])
+            if key in candidates:
+                candidates.remove(key)
+                candidates.insert(0, key)
+
+        return candidates
+
+    def _make_server(self, host, port, use_ssl):
+        """Server ldap3; schema e info DSA vengono scaricati solo se fetch_schema è attivo"""
+        return Server(host, port=port, use_ssl=use_ssl,
+                      get_info=ALL if self.fetch_schema else NONE,
+                      connect_timeout=self.connect_timeout)
+
+    def _bind(self, host, port, use_ssl, format_name):
+        """Apre una connessione in bind verso un DC; solleva eccezione se fallisce"""
+        user = self._user_formats(host)[format_name]
+        start = time.perf_counter()
+        conn = Connection(
+            self._make_server(host, port, use_ssl),
+            user,
+            self.password,
+            auto_bind=True,
+            raise_exceptions=True,
+            receive_timeout=self.receive_timeout
+        )
+        self.dc_pool.mark_ok(host, time.perf_counter() - start)
+        return conn
+
+    def _connect_to_dc(self, host):
+        """
+        Prova tutte le combinazioni porta/formato su un DC
+
+        Se una porta non è raggiungibile o non risponde (apertura, invio o
+        ricezione falliti) le altre combinazioni sulla stessa porta vengono
+        saltate e, se il bind non riesce su nessuna porta, il DC viene
+        segnato come non disponibile.
+
+        Returns:
+            True se connesso (self.connection impostata)
+        """
+        unreachable = set()
+        last_error = None
+        for port, use_ssl, format_name in self._bind_candidates(host):
+            if port in unreachable:
+                continue
+            user = self._user_formats(host)[format_name]
+            try:
+                print(f"  Provo con formato: {user} (porta {port})")
+                self.connection = self._bind(host, port, use_ssl, format_name)
+            except LDAPCommunicationError as e:
+                print(f"  ✗ {host}:{port} non raggiungibile o non risponde: {str(e)[:100]}")
+                unreachable.add(port)
+                last_error = e
+                continue
+            except Exception as e:
+                print(f"  ✗ Formato {user} fallito: {str(e)[:100]}")
+                last_error = e
+                continue
+            
+            self.ad_server = host
+            self._bind_params = {'port': port, 'use_ssl': use_ssl, 'format': format_name}
+            print(f"✓ Connesso ad Active Directory: {host}{' via LDAPS' if use_ssl else ''}")
+            print(f"  Formato username utilizzato: {user}")
+            
+            # Ricorda la combinazione funzionante per il prossimo avvio
+            bind = {'port': port, 'use_ssl': use_ssl, 'format': format_name}
+            if self.state.get('bind', host) != bind:
+                self.state.set('bind', host, bind)
+                try:
+                    self.state.save()
+                except OSError as e:
+                    print(f"  ⚠ Impossibile salvare il file di stato: {e}")
+            return True
+        
+        if unreachable:
+            self.dc_pool.mark_failed(host)
+        self._last_connect_error = last_error
+        return False
+
+    def connect_to_ad(self):
+        """Connette ad Active Directory (al primo domain controller disponibile)"""
+        start = time.perf_counter()
+        connected = self._connect_to_any_dc()
+        self.metrics.observe('connect', time.perf_counter() - start, 1 if connected else 0, errors=0 if connected else 1)
+        return connected
+
+    def _connect_to_any_dc(self):
+        print(f"\n→ Tentativo connessione a: {', '.join(self.dc_pool.hosts)}")
+        print(f"  Dominio: {self.domain}")
+        print(f"  Username: {self.username}")
+        
+        self._last_connect_error = None
+        for host in self.dc_pool.ordered():
+            if len(self.dc_pool.hosts) > 1:
+                print(f"\n→ Domain controller: {host}")
+            if self._connect_to_dc(host):
+                return True
+        
+        print(f"\n✗ Errore connessione AD: {self._last_connect_error}")
+        print("\n🔍 Suggerimenti:")
+        print("  1. Verifica che il server AD sia raggiungibile (ping adds.cartongrp.com)")
+        print("  2. Controlla username e password")
+        print("  3. Verifica che il firewall permetta connessioni LDAP (porta 389/636)")
+        print("  4. Prova a usare l'IP del server invece del nome DNS")
+        print("  5. Assicurati che l'account abbia permessi di lettura su AD")
+        return False
+    
+    def open_connection(self):
+        """
+        Apre una nuova connessione autenticata con gli stessi parametri
+        che hanno funzionato in connect_to_ad()
+
+        I DC vengono scelti a rotazione tra quelli disponibili, così le
+        connessioni di un pool si distribuiscono su tutti i domain controller.
+
+        Returns:
+            Connessione ldap3 già in bind
+        """
+        if not self._bind_params:
+            raise RuntimeError("Non connesso ad AD. Esegui connect_to_ad() prima.")
+
+        params = self._bind_params
+        last_error = None
+        for host in self.dc_pool.ordered(rotate=True):
+            try:
+                return self._bind(host, params['port'], params['use_ssl'], params['format'])
+            except LDAPCommunicationError as e:
+                self.dc_pool.mark_failed(host)
+                last_error = e
+        raise last_error or RuntimeError("Nessun domain controller disponibile")
+
+    def search_multiple_ous(self, search_bases, search_filter="(objectClass=user)",
+                            max_connections=DEFAULT_POOL_SIZE, page_size=DEFAULT_PAGE_SIZE):
+        """
+        Cerca utenti in più OU in parallelo su un pool di connessioni
+
+        Args:
+            search_bases: Dizionario {nome sede: Base DN} delle OU da interrogare
+            search_filter: Filtro LDAP
+            max_connections: Numero massimo di connessioni LDAP contemporanee
+            page_size: Numero di entry per pagina (paged results)
+
+        Returns:
+            Tupla (utenti senza duplicati, {nome sede: secondi impiegati})
+        """
+        pool = LDAPConnectionPool(self.open_connection, max_connections)
+
+        def search_ou(base_dn):
+            start = time.perf_counter()
+            with pool.connection() as conn:
+                users = list(self.iter_users(search_filter, page_size, search_base=base_dn, connection=conn))
+            return users, time.perf_counter() - start
+
+        results = {}
+        latencies = {}
+        try:
+            with ThreadPoolExecutor(max_workers=max_connections) as executor:
+                futures = {executor.submit(search_ou, base_dn): name for name, base_dn in search_bases.items()}
+                for future in as_completed(futures):
+                    name = futures[future]
+                    try:
+                        results[name], latencies[name] = future.result()
+                        print(f"  ✓ {name}: {len(results[name])} utenti in {latencies[name]:.2f}s")
+                    except Exception as e:
+                        print(f"  ✗ {name}: ricerca fallita: {e}")
+        finally:
+            pool.close()
+
+        # Unisci i risultati nell'ordine delle sedi eliminando i duplicati
+        users = []
+        seen = set()
+        for name in search_bases:
+            for user in results.get(name, []):
+                key = (user['username'] or user['dn']).lower()
+                if key in seen:
+                    continue
+                seen.add(key)
+                users.append(user)
+
+        return users, latencies
+
+    def iter_user_pages(self, search_filter="(objectClass=user)", page_size=DEFAULT_PAGE_SIZE, search_base=None,
+                        connection=None):
+        """
+        Cerca utenti in Active Directory con paged results (RFC 2696)
+
+        Ogni pagina viene richiesta al server solo quando il chiamante ha
+        consumato la precedente, quindi la memoria resta limitata a una
+        pagina anche su OU molto grandi e si aggira il limite MaxPageSize di AD.
+
+        Args:
+            search_filter: Filtro LDAP (default: tutti gli utenti)
+            page_size: Numero di entry per pagina richieste al server
+            search_base: Base DN della ricerca (default: self.base_dn)
+            connection: Connessione da usare (default: self.connection)
+
+        Yields:
+            Liste di ADUser (solo utenti con email valida), una per pagina
+        """
+        conn = connection or self.connection
+        if not conn:
+            raise RuntimeError("Non connesso ad AD. Esegui connect_to_ad() prima.")
+
+        cookie = None
+        idx = 0
+        default_company = self.company_info['nome']
+        enricher = self.get_enricher()
+        attributes = self.search_attributes
+        if enricher:
+            attributes = list(attributes) + enricher.user_attributes()
+        while True:
+            start = time.perf_counter()
+            try:
+                conn.search(
+                    search_base=search_base or self.base_dn,
+                    search_filter=search_filter,
+                    search_scope=SUBTREE,
+                    attributes=attributes,
+                    paged_size=page_size,
+                    paged_cookie=cookie
+                )
+            except Exception:
+                self.metrics.observe('search', time.perf_counter() - start, 0, errors=1)
+                raise
+
+            page = []
+            raw_entries = []
+            for entry in conn.response or []:
+                if entry.get('type') != 'searchResEntry':
+                    continue
+                idx += 1
+                # AD non supporta filtri sul DN: le OU escluse vengono scartate qui
+                if self.excluded_ous and any(is_under(entry['dn'], ou) for ou in self.excluded_ous):
+                    continue
+                try:
+                    user = ADUser.from_raw_attributes(entry['dn'], entry['raw_attributes'], default_company)
+                except Exception as e:
+                    print(f"  ⚠ Errore elaborazione entry {idx}: {e}")
+                    continue
+
+                # Aggiungi solo se ha email valida
+                if user['email'] and '@' in user['email']:
+                    page.append(user)
+                    raw_entries.append((user, entry['raw_attributes']))
+
+            # Tempo della pagina: richiesta al server + costruzione degli ADUser
+            self.metrics.observe('search', time.perf_counter() - start, len(page))
+            # Il cookie va letto prima delle ricerche di arricchimento sulla stessa connessione
+            controls = (conn.result or {}).get('controls') or {}
+            cookie = controls.get(PAGED_RESULTS_OID, {}).get('value', {}).get('cookie')
+
+            if enricher and raw_entries:
+                with self.metrics.timer('enrich') as record:
+                    enricher.enrich(conn, raw_entries)
+                    record['items'] = len(raw_entries)
+            if page:
+                yield page
+
+            if not cookie:
+                break
+
+    def iter_users(self, search_filter="(objectClass=user)", page_size=DEFAULT_PAGE_SIZE, search_base=None,
+                   connection=None):
+        """
+        Come iter_user_pages(), ma restituisce un utente alla volta
+
+        Yields:
+            ADUser con email valida
+        """
+        for page in self.iter_user_pages(search_filter, page_size, search_base, connection):
+            yield from page
+
+    def search_users(self, search_filter="(objectClass=user)", page_size=DEFAULT_PAGE_SIZE, store=None):
+        """
+        Cerca utenti in Active Directory
+        
+        Args:
+            search_filter: Filtro LDAP (default: tutti gli utenti)
+            page_size: Numero di entry per pagina (paged results)
+            store: UserStore vuoto in cui accumulare gli utenti pagina per pagina
+        
+        Returns:
+            Lista di ADUser (o store, se indicato)
+        """
+        if not self.connection:
+            print("✗ Non connesso ad AD. Esegui connect_to_ad() prima.")
+            return []
+        
+        print(f"\n→ Ricerca in corso su Base DN: {self.base_dn}")
+        print(f"  Filtro: {search_filter}")
+        
+        try:
+            users = store if store is not None else []
+            error = None
+            try:
+                for page in self.iter_user_pages(search_filter, page_size):
+                    shown = len(users)
+                    for idx, user in enumerate(page[:max(0, 3 - shown)], shown + 1):  # Mostra primi 3 per debug
+                        print(f"    [{idx}] {user['display_name']} - {user['email']}")
+                    users.extend(page)
+            except LDAPException as e:
+                if users:
+                    raise
+                error = e
+            
+            result = self.connection.result or {}
+            if not users and (error or result.get('result', 0) != 0):
+                print(f"✗ Ricerca fallita. Codice: {error or result}")
+                print(f"  Messaggio: {result.get('description', 'Nessuna descrizione')}")
+                
+                # Prova con OU=Users se il Base DN non funziona
+                alt_base_dn = f"OU=Users,{self.base_dn}"
+                print(f"\n  Provo con Base DN alternativo: {alt_base_dn}")
+                users.extend(self.iter_users(search_filter, page_size, search_base=alt_base_dn))
+            
+            print(f"\n✓ Trovati {len(users)} utenti con email valida")
+            
+            if len(users) == 0:
+                print("\n⚠ Nessun utente con email trovato. Possibili cause:")
+                print("  1. Il Base DN non contiene utenti con email")
+                print("  2. L'account non ha permessi per leggere gli attributi")
+                print("  3. Gli utenti sono in una OU diversa")
+                print(f"\n  Vuoi provare a cercare in tutto l'albero? (s/n): ", end='')
+            
+            return users
+            
+        except Exception as e:
+            print(f"\n✗ Errore ricerca utenti: {e}")
+            print(f"  Tipo errore: {type(e).__name__}")
+            import traceback
+            print("\n  Dettagli tecnici:")
+            traceback.print_exc()
+            return []
+    
+    def _usn_key(self, search_base):
+        """Chiave dello stato: gli uSNChanged sono locali a ogni DC"""
+        return f"{self.connection.server.host}|{search_base}"
+
+    def search_changed_users(self, search_filter="(objectClass=user)", full=False, search_bases=None,
+                             page_size=DEFAULT_PAGE_SIZE, verbose=True):
+        """
+        Cerca solo gli utenti modificati dall'ultima sincronizzazione
+
+        Per ogni OU usa come high-water mark il più alto uSNChanged visto
+        sul DC corrente e interroga solo le entry con (uSNChanged>=N+1).
+        I nuovi valori restano in sospeso finché non si chiama
+        commit_sync_state(), da fare solo dopo aver distribuito le firme.
+
+        Args:
+            search_filter: Filtro LDAP di base
+            full: Ignora lo stato salvato e rilegge tutti gli utenti
+            search_bases: Lista di Base DN (default: [self.base_dn])
+            page_size: Numero di entry per pagina (paged results)
+            verbose: Stampa l'avanzamento per ogni OU
+
+        Returns:
+            Lista di ADUser modificati
+        """
+        if not self.connection:
+            print("✗ Non connesso ad AD. Esegui connect_to_ad() prima.")
+            return []
+
+        log = print if verbose else (lambda *args, **kwargs: None)
+        users = []
+        for search_base in search_bases or [self.base_dn]:
+            key = self._usn_key(search_base)
+            mark = None if full else self.state.get('usn', key)
+
+            ou_filter = search_filter
+            if mark is not None:
+                ou_filter = f"(&{search_filter}(uSNChanged>={mark + 1}))"
+                log(f"→ {search_base}: modifiche dopo uSNChanged {mark}")
+            else:
+                log(f"→ {search_base}: sincronizzazione completa")
+
+            highest = mark or 0
+            count = 0
+            for user in self.iter_users(ou_filter, page_size, search_base=search_base):
+                highest = max(highest, user['usn_changed'])
+                users.append(user)
+                count += 1
+
+            self._pending_usn[key] = highest
+            log(f"  ✓ {count} utenti da aggiornare")
+
+        return users
+
+    def commit_sync_state(self, save=True):
+        """
+        Salva gli high-water mark raccolti da search_changed_users()
+
+        Args:
+            save: Scrive anche il file di stato (False: aggiorna solo lo stato in memoria)
+        """
+        for key, usn in self._pending_usn.items():
+            self.state.set('usn', key, usn)
+        self._pending_usn.clear()
+        if save:
+            self.state.save()
+
+    def find_users_by_dn(self, dns, search_filter="(objectClass=user)", chunk_size=DEFAULT_LOOKUP_CHUNK):
+        """
+        Rilegge utenti di cui si conosce il DN, a blocchi di chunk_size
+
+        Gli utenti che non soddisfano search_filter (es. disabilitati) non
+        vengono restituiti.
+
+        Returns:
+            Lista di ADUser
+        """
+        by_domain = {}
+        for dn in sorted(set(dns)):
+            by_domain.setdefault(domain_of(dn), []).append(dn)
+        users = []
+        for domain, domain_dns in by_domain.items():
+            for start in range(0, len(domain_dns), chunk_size):
+                terms = ''.join(f"(distinguishedName={escape_filter_chars(dn)})"
+                                for dn in domain_dns[start:start + chunk_size])
+                users.extend(self.iter_users(f"(&{search_filter}(|{terms}))", search_base=domain))
+        return users
+
+    def get_template(self, name):
+        """
+        Restituisce un template della firma, caricato e compilato una sola volta
+
+        Args:
+            name: Nome del file nella cartella dei template (es. 'firma.htm')
+        """
+        template = self._templates.get(name)
+        if template is None:
+            template = SignatureTemplate.from_file(Path(self.template_dir) / name)
+            self._templates[name] = template
+        return template
+
+    def get_enricher(self):
+        """
+        DirectoryEnricher per i campi ENRICHMENT_FIELDS usati dai template
+
+        Creato alla prima ricerca (una sola volta anche con ricerche parallele);
+        None se i template non usano quei campi.
+        """
+        with self._enricher_lock:
+            if self.enricher is None and not self._enricher_checked:
+                self._enricher_checked = True
+                try:
+                    fields = self.template_fields()
+                except OSError:
+                    fields = set()
+                sources = {ENRICHMENT_FIELDS[field] for field in fields if field in ENRICHMENT_FIELDS}
+                if sources:
+                    self.enricher = DirectoryEnricher(sources, self.group_prefix, metrics=self.metrics)
+            return self.enricher
+
+    def template_fields(self):
+        """Segnaposto usati dai template HTML e TXT (di tutte le sedi, con branding)"""
+        if self.branding is None:
+            return self.get_template(HTML_TEMPLATE).fields | self.get_template(TXT_TEMPLATE).fields
+        fields = set()
+        for branding in self.branding.brandings():
+            for template in branding.templates.values():
+                fields |= template.fields
+        return fields
+
+    def template_attributes(self):
+        """
+        Attributi AD usati dai template attivi, più REQUIRED_ATTRIBUTES
+
+        Da assegnare a search_attributes per non trasferire attributi che
+        nessuna firma utilizza.
+        """
+        fields = self.template_fields()
+        return [attribute for field, attribute in FIELD_ATTRIBUTES
+                if field in fields or attribute in REQUIRED_ATTRIBUTES] + ['uSNChanged']
+
+    def render_parallel(self, users, processes, chunk_size=DEFAULT_RENDER_CHUNK):
+        """
+        Genera le firme su un pool di processi, a blocchi di chunk_size utenti
+
+        Ogni processo compila i template una sola volta; gli utenti viaggiano
+        come liste di tuple, non come oggetti uno per uno. I risultati tornano
+        nello stesso ordine di users, man mano che i blocchi sono pronti, con
+        al massimo due blocchi per processo in attesa.
+
+        Yields:
+            Tuple (user, (html, txt)), oppure (user, messaggio di errore)
+        """
+        users = iter(users)
+        if self.branding is None:
+            template_dir = Path(self.template_dir)
+            brandings = [(template_dir / HTML_TEMPLATE, template_dir / TXT_TEMPLATE, self.company_info)]
+            route = lambda user: 0
+        else:
+            index = {id(branding): i for i, branding in enumerate(self.branding.brandings())}
+            brandings = [(b.template_paths[HTML_TEMPLATE], b.template_paths[TXT_TEMPLATE], b.company_info)
+                         for b in self.branding.brandings()]
+            route = lambda user: index[id(self.branding.route(user))]
+        pending = deque()
+        assets = self.assets.values if self.assets else None
+        with ProcessPoolExecutor(processes, initializer=_init_render_worker,
+                                 initargs=(brandings, assets)) as executor:
+            while True:
+                while len(pending) < processes * 2:
+                    chunk = list(itertools.islice(users, chunk_size))
+                    if not chunk:
+                        break
+                    records = [user.astuple() + (user.extra, route(user)) for user in chunk]
+                    pending.append((chunk, executor.submit(_render_chunk, records)))
+                if not pending:
+                    return
+                chunk, future = pending.popleft()
+                rendered, seconds = future.result()
+                self.metrics.observe('render_parallel', seconds, len(chunk))
+                yield from zip(chunk, rendered)
+
+    def generate_signature_html(self, user):
+        """
+        Genera firma HTML per un utente
+        
+        Args:
+            user: ADUser (o dizionario con gli stessi campi)
+        
+        Returns:
+            Stringa HTML della firma
+        """
+        start = time.perf_counter()
+        signature = self._render_cached(HTML_TEMPLATE, user)
+        self.metrics.observe('render_html', time.perf_counter() - start)
+        return signature
+    
+    def generate_signature_txt(self, user):
+        """Genera firma in formato testo"""
+        start = time.perf_counter()
+        signature = self._render_cached(TXT_TEMPLATE, user)
+        self.metrics.observe('render_txt', time.perf_counter() - start)
+        return signature
+
+    def templates_for(self, user):
+        """
+        Template usati per la firma di un utente
+
+        Returns:
+            Tupla (nome del Branding, {nome template: SignatureTemplate})
+        """
+        if self.branding is None:
+            return 'default', {name: self.get_template(name) for name in (HTML_TEMPLATE, TXT_TEMPLATE)}
+        branding = self.branding.route(user)
+        return branding.name, branding.templates
+
+    def _render_cached(self, name, user):
+        """Genera un template per l'utente (con il Branding della sua sede) passando dalla render_cache"""
+        if self.branding is None:
+            template, company_info = self.get_template(name), self.company_info
+        else:
+            branding = self.branding.route(user)
+            template, company_info = branding.templates[name], branding.company_info
+        assets = self.assets.values if self.assets else None
+        if self.render_cache.max_size <= 0:
+            return template.render(template_values(user, company_info, assets))
+
+        key = template.cache_key(user, company_info)
+        signature = self.render_cache.get(key)
+        if signature is None:
+            signature = template.render(template_values(user, company_info, assets))
+            self.render_cache.put(key, signature)
+        return signature
+    
+    def _manifest_for(self, root):
+        """Restituisce (creandolo una sola volta) il manifest di una cartella di output"""
+        key = str(root)
+        with self._manifest_lock:
+            if key not in self._manifests:
+                self._manifests[key] = SignatureManifest(root)
+            return self._manifests[key]
+
+    def _count(self, counter, amount=1):
+        with self._stats_lock:
+            self.write_stats[counter] += amount
+
+    def _with_retries(self, func, *args, **kwargs):
+        """Esegue un'operazione di I/O riprovando gli errori transitori con backoff esponenziale"""
+        for attempt in range(self.io_retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except OSError as e:
+                if attempt >= self.io_retries or not is_transient_io_error(e):
+                    raise
+                time.sleep(self.io_backoff * 2 ** attempt)
+
+    def _write_signature_files(self, manifest, folder, files):
         """
-        Inizializza la connessione ad Active Directory
-        
+        Scrive i file firma solo se il contenuto è cambiato rispetto al manifest
+
         Args:
-            ad_server: Server AD (es. 'dc.azienda.local')
-            domain: Dominio (es. 'AZIENDA')
-            base_dn: Base DN (es. 'DC=azienda,DC=local')
-            username: Username AD con permessi di lettura
-            password: Password
+            manifest: SignatureManifest della cartella di output
+            folder: Cartella di destinazione dei file
+            files: Lista di tuple (nome file, contenuto)
+
+        Returns:
+            Lista dei file effettivamente scritti
         """
-        self.ad_server = ad_server
-        self.domain = domain
-        self.base_dn = base_dn
-        self.username = username
-        self.password = password
-        self.connection = None
-        
-        # Configurazione aziendale
-        self.company_info = {
-            'nome': 'La Tua Azienda S.r.l.',
-            'indirizzo': 'Via Roma 123, 20100 Milano (MI)',
-            'website': 'www.tuaazienda.it',
-            'logo_url': 'https://www.tuaazienda.it/logo.png',
-            'colore_primario': '#0066cc',
-            'colore_secondario': '#666666',
-            'disclaimer': 'Questo messaggio è confidenziale. Se non siete il destinatario, vi preghiamo di eliminarlo.'
+        pending = []
+        for name, content in files:
+            key = f"{folder.relative_to(manifest.root).as_posix()}/{name}"
+            digest = content_hash(content)
+            if manifest.is_unchanged(key, digest):
+                self._count('skipped')
+            else:
+                pending.append((key, digest, folder / name, content))
+
+        if not pending:
+            return []
+
+        written = []
+        nbytes = 0
+        start = time.perf_counter()
+        try:
+            self._with_retries(folder.mkdir, parents=True, exist_ok=True)
+            for key, digest, path, content in pending:
+                self._with_retries(path.write_text, content, encoding='utf-8')
+                manifest.update(key, digest)
+                self._count('written')
+                written.append(path)
+                nbytes += len(content.encode('utf-8'))
+        except Exception:
+            self._count('failed', len(pending) - len(written))
+            self.metrics.observe('write', time.perf_counter() - start, len(written), nbytes, 1)
+            raise
+        finally:
+            self._count('bytes', nbytes)
+        self.metrics.observe('write', time.perf_counter() - start, len(written), nbytes)
+        return written
+
+    def signature_name(self):
+        """Nome dei file firma in Outlook (senza estensione)"""
+        return f"Firma-{self.company_info['nome'].replace(' ', '-')}"
+
+    def render_signature_files(self, user, output_folder=None, target_username=None, rendered=None):
+        """
+        Genera i file firma di un utente senza scriverli
+
+        Args:
+            user: ADUser
+            output_folder: Cartella di esportazione (come save_signature_to_file);
+                None per il profilo Outlook dell'utente (come deploy_signature_to_user)
+            target_username: Username Windows del profilo (default: username AD)
+            rendered: (html, txt) già generati da render_parallel(), o il suo messaggio di errore
+
+        Returns:
+            Tupla (manifest, cartella di destinazione, lista di (nome file, contenuto))
+        """
+        if isinstance(rendered, str):
+            raise RuntimeError(rendered)
+        html_signature, txt_signature = rendered or (self.generate_signature_html(user),
+                                                     self.generate_signature_txt(user))
+        if output_folder:
+            output_path = Path(output_folder)
+            return self._manifest_for(output_path), output_path / user['username'], [
+                ("firma.htm", html_signature),
+                ("firma.txt", txt_signature),
+            ]
+
+        # Percorso firma Outlook
+        signature_folder = Path(self.profiles_root, target_username or user['username'],
+                                'AppData', 'Roaming', 'Microsoft', 'Signatures')
+        signature_name = self.signature_name()
+        return self._manifest_for(Path(self.profiles_root)), signature_folder, [
+            (f"{signature_name}.htm", html_signature),
+            (f"{signature_name}.txt", txt_signature),
+        ]
+
+    def _deploy_files(self, user, target_username=None, rendered=None):
+        """
+        Genera e scrive la firma nel profilo Outlook dell'utente
+
+        Returns:
+            Tupla (cartella firme, lista dei file scritti)
+        """
+        # Genera e salva firme HTML e TXT (solo se cambiate)
+        with self.metrics.timer('deploy'):
+            manifest, signature_folder, files = self.render_signature_files(user, target_username=target_username,
+                                                                            rendered=rendered)
+            written = self._write_signature_files(manifest, signature_folder, files)
+            if self.assets and self.assets.linked:
+                written += self._link_assets(self.profiles_root, signature_folder)
+            return signature_folder, written
+
+    def default_signature_values(self):
+        """
+        Valori di registro che rendono la firma predefinita in Outlook
+
+        Returns:
+            Tupla (chiave sotto HKEY_CURRENT_USER, {nome valore: firma})
+        """
+        signature_name = self.signature_name()
+        key_path = MAIL_SETTINGS_KEY.format(version=self.office_version)
+        return key_path, {'NewSignature': signature_name, 'ReplySignature': signature_name}
+
+    def write_reg_file(self, path):
+        """
+        Scrive un file .reg con la firma predefinita, da importare al logon
+        di ogni utente (reg import / GPO): un solo file per tutto il batch
+        """
+        key_path, values = self.default_signature_values()
+        lines = ['Windows Registry Editor Version 5.00', '', f'[HKEY_CURRENT_USER\\{key_path}]']
+        lines += [f'{_reg_string(name)}={_reg_string(value)}' for name, value in values.items()]
+        # regedit si aspetta UTF-16 con BOM e righe CRLF
+        with open(path, 'w', encoding='utf-16', newline='\r\n') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def write_defaults_manifest(self, path, usernames):
+        """Scrive un manifest JSON con chiave, valori e utenti a cui applicarli (Intune, script)"""
+        key_path, values = self.default_signature_values()
+        manifest = {
+            'office_version': self.office_version,
+            'hive': 'HKEY_CURRENT_USER',
+            'key': key_path,
+            'values': values,
+            'users': sorted(usernames),
         }
-    
-    def connect_to_ad(self):
-        """Connette ad Active Directory"""
-        print(f"\n→ Tentativo connessione a: {self.ad_server}")
-        print(f"  Dominio: {self.domain}")
-        print(f"  Username: {self.username}")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    def apply_default_signature(self, usernames=()):
+        """
+        Imposta la firma come predefinita, una volta per tutto il batch
+
+        Con reg_file e/o defaults_manifest scrive un unico file per tutti gli
+        utenti; altrimenti scrive nel registro dell'utente corrente, se
+        disponibile (registry è None fuori da Windows: passo saltato).
+
+        Args:
+            usernames: Username degli utenti distribuiti (per il manifest)
+
+        Returns:
+            True se almeno un'uscita è stata scritta
+        """
+        done = False
+        with self.metrics.timer('defaults'):
+            try:
+                if self.reg_file:
+                    self.write_reg_file(self.reg_file)
+                    print(f"  ✓ Firma predefinita in {self.reg_file} (Office {self.office_version})")
+                    done = True
+                if self.defaults_manifest:
+                    self.write_defaults_manifest(self.defaults_manifest, usernames)
+                    print(f"  ✓ Manifest firma predefinita in {self.defaults_manifest}")
+                    done = True
+                if not done and self.registry is not None:
+                    self.registry.set_values(*self.default_signature_values())
+                    print(f"  ✓ Firma impostata come predefinita in Outlook (Office {self.office_version})")
+                    done = True
+            except OSError as e:
+                print(f"  ⚠ Avviso: Non è stato possibile impostare la firma come predefinita: {e}")
+        return done
+
+    def deploy_signature_to_user(self, user, target_username=None, set_default=True):
+        """
+        Distribuisce la firma per un utente specifico
+        
+        Args:
+            user: ADUser (o dizionario con gli stessi campi)
+            target_username: Username Windows (default: username AD dell'utente)
+            set_default: Imposta anche la firma predefinita (apply_default_signature)
         
+        Returns:
+            True se successo, False altrimenti
+        """
         try:
-            # Prova prima con LDAP standard (porta 389)
-            server = Server(self.ad_server, port=389, get_info=ALL)
-            
-            # Prova diverse varianti del formato username
-            user_formats = [
-                f"{self.domain}\\{self.username}",  # DOMAIN\username
-                f"{self.username}@{self.ad_server}",  # username@server
-                f"{self.username}@{self.domain}",  # username@DOMAIN
-                self.username  # username semplice
-            ]
-            
-            connected = False
-            for user_format in user_formats:
-                try:
-                    print(f"  Provo con formato: {user_format}")
-                    self.connection = Connection(
-                        server, 
-                        user_format, 
-                        self.password, 
-                        auto_bind=True,
-                        raise_exceptions=True
-                    )
-                    connected = True
-                    print(f"✓ Connesso ad Active Directory: {self.ad_server}")
-                    print(f"  Formato username utilizzato: {user_format}")
-                    break
-                except Exception as e:
-                    print(f"  ✗ Formato {user_format} fallito: {str(e)[:100]}")
-                    continue
-            
-            if not connected:
-                # Prova LDAPS (porta 636)
-                print("\n  Provo connessione sicura LDAPS (porta 636)...")
-                server = Server(self.ad_server, port=636, use_ssl=True, get_info=ALL)
-                user_dn = f"{self.domain}\\{self.username}"
-                self.connection = Connection(server, user_dn, self.password, auto_bind=True)
-                print(f"✓ Connesso via LDAPS")
-                connected = True
-            
-            return connected
-            
+            _, written = self._deploy_files(user, target_username)
+            if not self.quiet:
+                for path in written:
+                    print(f"  ✓ Salvata firma: {path}")
+                if not written:
+                    print(f"  = Firma invariata per {user['display_name']}, nessuna scrittura")
         except Exception as e:
-            print(f"\n✗ Errore connessione AD: {e}")
-            print("\n🔍 Suggerimenti:")
-            print("  1. Verifica che il server AD sia raggiungibile (ping adds.cartongrp.com)")
-            print("  2. Controlla username e password")
-            print("  3. Verifica che il firewall permetta connessioni LDAP (porta 389/636)")
-            print("  4. Prova a usare l'IP del server invece del nome DNS")
-            print("  5. Assicurati che l'account abbia permessi di lettura su AD")
+            print(f"  ✗ Errore salvataggio firma per {user['display_name']}: {e}")
             return False
+        
+        if set_default:
+            self.apply_default_signature([target_username or user['username']])
+        return True
     
-    def search_users(self, search_filter="(objectClass=user)"):
+    def _save_files(self, user, output_folder, rendered=None):
         """
-        Cerca utenti in Active Directory
+        Genera e scrive la firma nella sottocartella dell'utente
+
+        Returns:
+            Tupla (cartella utente, lista dei file scritti)
+        """
+        # Salva HTML e TXT (solo se cambiati)
+        with self.metrics.timer('save'):
+            manifest, user_folder, files = self.render_signature_files(user, output_folder, rendered=rendered)
+            written = self._write_signature_files(manifest, user_folder, files)
+            if self.assets and self.assets.linked:
+                written += self._link_assets(output_folder, user_folder)
+            return user_folder, written
+
+    def _link_assets(self, root, folder):
+        """Collega le immagini accanto alla firma (AssetStore in modalità 'files')"""
+        start = time.perf_counter()
+        created = self._with_retries(self.assets.link_into, root, folder)
+        nbytes = sum(len(self.assets.files[path.name]) for path in created)
+        self.metrics.observe('assets', time.perf_counter() - start, len(created), nbytes)
+        if created:
+            self._count('written', len(created))
+            self._count('bytes', nbytes)
+        return created
+
+    def save_signature_to_file(self, user, output_folder="./firme"):
+        """
+        Salva la firma in una cartella locale (per distribuzione manuale)
         
         Args:
-            search_filter: Filtro LDAP (default: tutti gli utenti)
+            user: ADUser (o dizionario con gli stessi campi)
+            output_folder: Cartella dove salvare le firme
+        """
+        user_folder, written = self._save_files(user, output_folder)
         
+        if not self.quiet:
+            print(f"{'✓ Firma salvata' if written else '= Firma invariata'} in: {user_folder}")
+        return str(user_folder)
+
+    def export_archive(self, users, archive_path, with_manifest=False, processes=0):
+        """
+        Esporta le firme di più utenti in un unico archivio ZIP o tar
+
+        Ogni utente diventa una cartella username/ con firma.htm e firma.txt,
+        come in save_signature_to_file, ma tutto viene scritto in un solo
+        file sequenziale invece di una cartella e due file per utente.
+        Il formato dipende dall'estensione (.zip, .tar, .tar.gz, .tgz);
+        l'archivio compare nel percorso finale solo se completo.
+
+        Args:
+            users: Lista di ADUser
+            archive_path: Percorso dell'archivio da creare (sovrascritto se esiste)
+            with_manifest: Aggiunge manifest.json con l'indice di utenti, file e hash e i template
+                usati per ogni branding (templates_for())
+            processes: Se maggiore di 1 genera le firme con render_parallel()
+
         Returns:
-            Lista di dizionari con i dati degli utenti
+            Lista di DeployResult, nello stesso ordine di users
         """
-        if not self.connection:
-            print("✗ Non connesso ad AD. Esegui connect_to_ad() prima.")
-            return []
-        
-        attributes = [
-            'sAMAccountName', 'displayName', 'givenName', 'sn',
-            'title', 'mail', 'telephoneNumber', 'mobile',
-            'department', 'company', 'physicalDeliveryOfficeName'
-        ]
-        
-        print(f"\n→ Ricerca in corso su Base DN: {self.base_dn}")
-        print(f"  Filtro: {search_filter}")
-        
+        archive_path = str(archive_path)
+        tmp_path = f"{archive_path}.tmp"
+        results = []
+        index = []
+        used_templates = {}  # branding -> {template: versione}
+
+        with self.metrics.timer('archive') as record:
+            if archive_path.lower().endswith('.zip'):
+                archive = zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED)
+
+                def add(name, data):
+                    archive.writestr(name, data)
+
+                def add_link(name, target, data):
+                    # Lo ZIP non ha hardlink: le immagini già lette vengono solo ricopiate
+                    archive.writestr(name, data)
+            else:
+                archive = tarfile.open(tmp_path, 'w:gz' if archive_path.lower().endswith(('.gz', '.tgz')) else 'w')
+                mtime = time.time()
+
+                def add(name, data):
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    info.mtime = mtime
+                    archive.addfile(info, io.BytesIO(data))
+
+                def add_link(name, target, data):
+                    info = tarfile.TarInfo(name)
+                    info.type = tarfile.LNKTYPE
+                    info.linkname = target
+                    info.mtime = mtime
+                    archive.addfile(info)
+
+            # Immagini in modalità 'files': la prima copia nell'archivio, poi collegamenti
+            asset_files = self.assets.files.items() if self.assets and self.assets.linked else ()
+            asset_paths = {}
+
+            try:
+                with archive:
+                    for user, rendered in self._rendered(users, processes):
+                        start = time.perf_counter()
+                        try:
+                            if isinstance(rendered, str):
+                                raise RuntimeError(rendered)
+                            html_signature, txt_signature = rendered or (self.generate_signature_html(user),
+                                                                         self.generate_signature_txt(user))
+                            files = [
+                                ("firma.htm", html_signature.encode('utf-8')),
+                                ("firma.txt", txt_signature.encode('utf-8')),
+                            ]
+                        except Exception as e:
+                            results.append(DeployResult(user['username'], False, error=str(e),
+                                                        elapsed=time.perf_counter() - start))
+                            continue
+                        for name, data in files:
+                            add(f"{user['username']}/{name}", data)
+                        for filename, data in asset_files:
+                            path = f"{user['username']}/{self.assets.folder_name}/{filename}"
+                            if filename in asset_paths:
+                                add_link(path, asset_paths[filename], data)
+                            else:
+                                add(path, data)
+                                asset_paths[filename] = path
+                        if with_manifest:
+                            branding_name, templates = self.templates_for(user)
+                            used_templates.setdefault(branding_name, {
+                                name: template.version for name, template in templates.items()})
+                            index.append({
+                                'username': user['username'],
+                                'display_name': user['display_name'],
+                                'email': user['email'],
+                                'branding': branding_name,
+                                'files': {name: hashlib.sha256(data).hexdigest() for name, data in files},
+                            })
+                        results.append(DeployResult(user['username'], True, user['username'], len(files),
+                                                    elapsed=time.perf_counter() - start))
+
+                    if with_manifest:
+                        add(ARCHIVE_MANIFEST, json.dumps({
+                            'created': datetime.now().isoformat(timespec='seconds'),
+                            'templates': used_templates,
+                            'users': index,
+                        }, ensure_ascii=False, indent=1).encode('utf-8'))
+                os.replace(tmp_path, archive_path)
+            except BaseException:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+
+            record['items'] = sum(1 for r in results if r.ok)
+            record['bytes'] = os.path.getsize(archive_path)
+
+        print(f"✓ Archivio creato: {archive_path} ({record['items']} firme, {record['bytes']} byte)")
+        return results
+
+    def _rendered(self, users, processes):
+        """Coppie (user, firme già generate o None) per deploy_batch ed export_archive"""
+        if processes > 1 and users:
+            return self.render_parallel(users, processes)
+        return zip(users, itertools.repeat(None))
+
+    @contextmanager
+    def _file_server_slot(self, path):
+        """Limita le scritture contemporanee verso lo stesso file server"""
+        server = file_server_of(path)
+        with self._stats_lock:
+            slot = self._server_slots.get(server)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self.max_writes_per_server)
+                self._server_slots[server] = slot
+        with slot:
+            yield
+
+    def deploy_batch(self, users, output_folder=None, max_workers=DEFAULT_DEPLOY_WORKERS, processes=0):
+        """
+        Distribuisce le firme di più utenti in parallelo
+
+        Le scritture vengono distribuite su un pool di thread, limitando le
+        scritture contemporanee per file server (max_writes_per_server) e
+        riprovando gli errori di I/O transitori (io_retries, io_backoff).
+
+        Args:
+            users: Lista di ADUser
+            output_folder: Se indicata salva le firme qui (come save_signature_to_file),
+                altrimenti le distribuisce nei profili (come deploy_signature_to_user)
+            max_workers: Numero di thread di scrittura
+            processes: Se maggiore di 1 le firme vengono generate su questo numero di
+                processi (render_parallel) e scritte man mano che arrivano
+
+        Returns:
+            Lista di DeployResult, nello stesso ordine di users
+        """
+        root = output_folder or self.profiles_root
+
+        def deploy_one(user, rendered):
+            start = time.perf_counter()
+            try:
+                with self._file_server_slot(root):
+                    if output_folder:
+                        folder, written = self._save_files(user, output_folder, rendered)
+                    else:
+                        folder, written = self._deploy_files(user, rendered=rendered)
+                return DeployResult(user['username'], True, str(folder), len(written),
+                                    elapsed=time.perf_counter() - start)
+            except Exception as e:
+                return DeployResult(user['username'], False, error=str(e),
+                                    elapsed=time.perf_counter() - start)
+
+        results = [None] * len(users)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(deploy_one, user, rendered): idx
+                       for idx, (user, rendered) in enumerate(self._rendered(users, processes))}
+            for done, future in enumerate(as_completed(futures), 1):
+                result = future.result()
+                results[futures[future]] = result
+                if result.ok and not self.quiet:
+                    print(f"  [{done}/{len(users)}] ✓ {result.username} ({result.written} file scritti)")
+                elif not result.ok:
+                    print(f"  [{done}/{len(users)}] ✗ {result.username}: {result.error}")
+
+        deployed = [r.username for r in results if r.ok]
+        if not output_folder and deployed:
+            self.apply_default_signature(deployed)
+
+        return results
+
+    def finish_writes(self):
+        """
+        Salva i manifest delle cartelle di output e stampa i contatori
+
+        I contatori ripartono da zero: ogni chiamata riporta solo le scritture
+        successive alla precedente (es. un aggiornamento di --watch).
+
+        Returns:
+            Dizionario con i contatori written/skipped/failed/bytes
+        """
+        with self._manifest_lock:
+            manifests = list(self._manifests.values())
+        for manifest in manifests:
+            try:
+                manifest.save()
+            except Exception as e:
+                print(f"⚠ Impossibile salvare il manifest {manifest.path}: {e}")
+
+        with self._stats_lock:
+            stats = dict(self.write_stats)
+            self.write_stats = dict.fromkeys(stats, 0)
+        print(f"\n→ File scritti: {stats['written']} ({stats['bytes']} byte), "
+              f"invariati: {stats['skipped']}, errori: {stats['failed']}")
+        return stats
+
+
+# Utenti per pagina nella tabella interattiva
+DEFAULT_BROWSE_PAGE_SIZE = 50
+
+
+def display_users(users, positions=None):
+    """
+    Mostra lista utenti in formato tabella
+
+    Args:
+        users: Utenti da mostrare
+        positions: Numeri da mostrare nella colonna # (default: 1, 2, 3...)
+    """
+    if not users:
+        print("Nessun utente trovato.")
+        return
+    
+    print("\n" + "="*100)
+    print(f"{'#':<6} {'Username':<15} {'Nome Completo':<30} {'Email':<35}")
+    print("="*100)
+    
+    for idx, user in zip(positions or range(1, len(users) + 1), users):
+        print(f"{idx:<6} {user['username']:<15} {user['display_name']:<30} {user['email']:<35}")
+    
+    print("="*100 + "\n")
+
+
+def browse_users(store, page_size=DEFAULT_BROWSE_PAGE_SIZE):
+    """
+    Mostra gli utenti di uno UserStore una pagina alla volta
+
+    Comandi: invio pagina successiva, 'p' precedente, un numero per andare
+    a quella pagina, '/testo' per cercare per username/email, 'q' per tornare al menu.
+    """
+    pages = max(1, -(-len(store) // page_size))
+    page = 1
+    while True:
+        rows = store.page(page, page_size)
+        display_users([user for _, user in rows], [pos for pos, _ in rows])
+        if pages == 1:
+            return
+        command = input(f"Pagina {page}/{pages} - [invio] avanti, p indietro, N pagina, /testo cerca, q menu: ").strip()
+        if command.lower() == 'q':
+            return
+        if command.startswith('/'):
+            matches = store.find(command[1:].strip(), limit=page_size)
+            display_users([user for _, user in matches], [pos for pos, _ in matches])
+            input("Invio per tornare all'elenco...")
+        elif command.lower() == 'p':
+            page = max(1, page - 1)
+        elif command.isdigit():
+            page = min(max(1, int(command)), pages)
+        elif page < pages:
+            page += 1
+        else:
+            return
+
+
+def select_users(store, selection):
+    """
+    Risolve una selezione separata da virgole in utenti
+
+    Ogni voce può essere un numero (posizione nell'elenco) oppure l'inizio
+    di username o email: il prefisso deve identificare un solo utente,
+    salvo corrispondenza esatta di username o email.
+
+    Returns:
+        Lista di ADUser selezionati (le voci non valide vengono segnalate)
+    """
+    selected = []
+    for token in (part.strip() for part in selection.split(',')):
+        if not token:
+            continue
+        if token.isdigit():
+            if 1 <= int(token) <= len(store):
+                selected.append(store[int(token) - 1])
+            else:
+                print(f"  ⚠ Numero fuori elenco: {token}")
+            continue
+        matches = store.find(token, limit=20)
+        exact = [user for _, user in matches if token.lower() in (user['username'].lower(), user['email'].lower())]
+        if exact:
+            selected.append(exact[0])
+        elif len(matches) == 1:
+            selected.append(matches[0][1])
+        elif not matches:
+            print(f"  ⚠ Nessun utente per '{token}'")
+        else:
+            print(f"  ⚠ '{token}' corrisponde a più utenti ({', '.join(u['username'] for _, u in matches[:5])}...)")
+    return selected
+
+
+class StageStats:
+    """Contatori di una fase della pipeline: elementi elaborati e tempo di lavoro"""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+
+    def add(self, items, seconds):
+        self.items += items
+        self.busy += seconds
+
+    def as_dict(self):
+        return {
+            'items': self.items,
+            'busy_seconds': round(self.busy, 3),
+            'per_second': round(self.items / self.busy, 1) if self.busy > 0 else None,
+        }
+
+
+class SignaturePipeline:
+    """
+    Pipeline asincrona ricerca -> generazione -> scrittura delle firme
+
+    Le tre fasi girano in parallelo collegate da code limitate: la ricerca
+    paged (una per OU, ognuna sulla propria connessione) produce pagine di
+    utenti, la generazione trasforma ogni utente nei suoi file firma e più
+    writer li scrivono su disco. Se una fase rallenta le code si riempiono e
+    le fasi precedenti si fermano (backpressure), quindi la memoria resta
+    limitata e il tempo totale tende a quello della fase più lenta.
+    """
+
+    def __init__(self, manager, search_filter, search_bases, output_folder=None,
+                 page_size=DEFAULT_PAGE_SIZE, queue_size=DEFAULT_QUEUE_SIZE,
+                 writers=DEFAULT_DEPLOY_WORKERS, dry_run=False):
+        """
+        Args:
+            manager: ADSignatureManager già connesso
+            search_filter: Filtro LDAP
+            search_bases: Lista di Base DN da interrogare
+            output_folder: Cartella di esportazione; None per distribuire nei profili
+            page_size: Numero di entry per pagina (paged results)
+            queue_size: Pagine in attesa tra ricerca e generazione
+            writers: Numero di writer paralleli
+            dry_run: Genera le firme senza scriverle
+        """
+        self.manager = manager
+        self.search_filter = search_filter
+        self.search_bases = list(search_bases)
+        self.output_folder = output_folder
+        self.page_size = page_size
+        self.queue_size = queue_size
+        self.writers = writers
+        self.dry_run = dry_run
+        self.stats = {name: StageStats(name) for name in ('search', 'render', 'write')}
+        self.deployed = 0
+        self.deployed_users = []
+        self.errors = []
+        self.search_errors = []
+
+    def run(self):
+        """
+        Esegue la pipeline fino all'ultimo utente
+
+        Returns:
+            Dizionario con utenti distribuiti, errori per utente, ricerche
+            fallite (per OU), contatori per fase e tempo totale
+        """
+        start = time.perf_counter()
+        asyncio.run(self._run())
+        return {
+            'deployed': self.deployed,
+            'deployed_users': self.deployed_users,
+            'failed': len(self.errors),
+            'errors': self.errors,
+            'search_errors': self.search_errors,
+            'stages': {name: stats.as_dict() for name, stats in self.stats.items()},
+            'elapsed': round(time.perf_counter() - start, 3),
+        }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.writers + len(self.search_bases) + 1))
+
+        render_queue = asyncio.Queue(self.queue_size)
+        write_queue = asyncio.Queue(self.writers * 4)
+
+        producers = [asyncio.create_task(self._produce(base, render_queue)) for base in self.search_bases]
+        renderer = asyncio.create_task(self._render(render_queue, write_queue))
+        writers = [asyncio.create_task(self._write(write_queue)) for _ in range(self.writers)]
+
+        for base, outcome in zip(self.search_bases, await asyncio.gather(*producers, return_exceptions=True)):
+            if isinstance(outcome, Exception):
+                self.search_errors.append(f"{base}: ricerca fallita: {outcome}")
+        await render_queue.put(None)
+        await renderer
+        await asyncio.gather(*writers)
+
+    async def _produce(self, search_base, render_queue):
+        """Fase 1: ricerca paged su una OU, una pagina alla volta"""
+        conn = await asyncio.to_thread(self.manager.open_connection)
         try:
-            result = self.connection.search(
-                search_base=self.base_dn,
-                search_filter=search_filter,
-                search_scope=SUBTREE,
-                attributes=attributes
-            )
-            
-            if not result:
-                print(f"✗ Ricerca fallita. Codice: {self.connection.result}")
-                print(f"  Messaggio: {self.connection.result.get('description', 'Nessuna descrizione')}")
-                
-                # Prova con OU=Users se il Base DN non funziona
-                alt_base_dn = f"OU=Users,{self.base_dn}"
-                print(f"\n  Provo con Base DN alternativo: {alt_base_dn}")
-                result = self.connection.search(
-                    search_base=alt_base_dn,
-                    search_filter=search_filter,
-                    search_scope=SUBTREE,
-                    attributes=attributes
-                )
-            
-            print(f"  Elaborazione risultati... ({len(self.connection.entries)} entries trovate)")
-            
-            users = []
-            for idx, entry in enumerate(self.connection.entries, 1):
+            pages = self.manager.iter_user_pages(self.search_filter, self.page_size, search_base, connection=conn)
+            while True:
+                start = time.perf_counter()
+                page = await asyncio.to_thread(next, pages, None)
+                if page is None:
+                    break
+                self.stats['search'].add(len(page), time.perf_counter() - start)
+                await render_queue.put(page)
+        finally:
+            await asyncio.to_thread(conn.unbind)
+
+    async def _render(self, render_queue, write_queue):
+        """Fase 2: generazione dei file firma (senza duplicati tra OU)"""
+        seen = set()
+        while True:
+            page = await render_queue.get()
+            if page is None:
+                break
+            for user in page:
+                key = (user['username'] or user['dn']).lower()
+                if key in seen:
+                    continue
+                seen.add(key)
+                start = time.perf_counter()
                 try:
-                    # Gestione sicura degli attributi
-                    def get_attr(entry, attr_name):
-                        try:
-                            if hasattr(entry, attr_name):
-                                val = getattr(entry, attr_name)
-                                if val and str(val) != '[]':
-                                    return str(val).strip('[]')
-                            return ''
-                        except:
-                            return ''
-                    
-                    user = {
-                        'username': get_attr(entry, 'sAMAccountName'),
-                        'display_name': get_attr(entry, 'displayName'),
-                        'first_name': get_attr(entry, 'givenName'),
-                        'last_name': get_attr(entry, 'sn'),
-                        'title': get_attr(entry, 'title'),
-                        'email': get_attr(entry, 'mail'),
-                        'phone': get_attr(entry, 'telephoneNumber'),
-                        'mobile': get_attr(entry, 'mobile'),
-                        'department': get_attr(entry, 'department'),
-                        'company': get_attr(entry, 'company') or self.company_info['nome'],
-                        'office': get_attr(entry, 'physicalDeliveryOfficeName')
-                    }
-                    
-                    # Aggiungi solo se ha email valida
-                    if user['email'] and '@' in user['email']:
-                        users.append(user)
-                        if idx <= 3:  # Mostra primi 3 per debug
-                            print(f"    [{idx}] {user['display_name']} - {user['email']}")
-                    
+                    item = self.manager.render_signature_files(user, self.output_folder)
                 except Exception as e:
-                    print(f"  ⚠ Errore elaborazione entry {idx}: {e}")
+                    self.errors.append(f"{user['username']}: {e}")
                     continue
-            
-            print(f"\n✓ Trovati {len(users)} utenti con email valida")
-            
-            if len(users) == 0:
-                print("\n⚠ Nessun utente con email trovato. Possibili cause:")
-                print("  1. Il Base DN non contiene utenti con email")
-                print("  2. L'account non ha permessi per leggere gli attributi")
-                print("  3. Gli utenti sono in una OU diversa")
-                print(f"\n  Vuoi provare a cercare in tutto l'albero? (s/n): ", end='')
-            
-            return users
-            
-        except Exception as e:
-            print(f"\n✗ Errore ricerca utenti: {e}")
-            print(f"  Tipo errore: {type(e).__name__}")
-            import traceback
-            print("\n  Dettagli tecnici:")
-            traceback.print_exc()
-            return []
-    
-    def generate_signature_html(self, user):
+                self.stats['render'].add(1, time.perf_counter() - start)
+                await write_queue.put((user, item))
+
+        for _ in range(self.writers):
+            await write_queue.put(None)
+
+    async def _write(self, write_queue):
+        """Fase 3: scrittura dei file firma (solo quelli cambiati)"""
+        while True:
+            item = await write_queue.get()
+            if item is None:
+                break
+            user, (manifest, folder, files) = item
+            start = time.perf_counter()
+            try:
+                if not self.dry_run:
+                    await asyncio.to_thread(self.manager._write_signature_files, manifest, folder, files)
+                    if self.manager.assets and self.manager.assets.linked:
+                        root = self.output_folder or self.manager.profiles_root
+                        await asyncio.to_thread(self.manager._link_assets, root, folder)
+                self.deployed += 1
+                self.deployed_users.append(user['username'])
+            except Exception as e:
+                self.errors.append(f"{user['username']}: {e}")
+            self.stats['write'].add(1, time.perf_counter() - start)
+
+
+# Modalità daemon (--watch): intervallo tra i controlli e raggruppamento delle modifiche
+DEFAULT_WATCH_INTERVAL = 5    # secondi tra due controlli delle modifiche
+DEFAULT_WATCH_DEBOUNCE = 3    # distribuisci quando non arrivano modifiche da questi secondi...
+DEFAULT_WATCH_MAX_DELAY = 60  # ...ma una modifica non aspetta mai più di così
+DIRSYNC_OID = '1.2.840.113556.1.4.841'
+
+
+class UsnChangeSource:
+    """
+    Modifiche trovate per polling su uSNChanged
+
+    Funziona con qualsiasi account in sola lettura e con qualunque server
+    LDAP che esponga uSNChanged (anche il mock di ldap3).
+    """
+
+    name = 'uSNChanged'
+
+    def __init__(self, manager, search_filter, search_bases):
+        self.manager = manager
+        self.search_filter = search_filter
+        self.search_bases = list(search_bases)
+
+    def poll(self):
+        """Utenti modificati dal controllo precedente"""
+        users = self.manager.search_changed_users(self.search_filter, search_bases=self.search_bases,
+                                                  verbose=False)
+        # Il controllo successivo riparte da qui; su disco solo dopo la distribuzione
+        self.manager.commit_sync_state(save=False)
+        return users
+
+    def commit(self):
+        self.manager.state.save()
+
+
+class DirSyncChangeSource:
+    """
+    Modifiche tramite il controllo DirSync di Active Directory
+
+    Il DC restituisce solo gli oggetti cambiati dal cookie precedente, senza
+    rileggere le OU; serve il permesso "Replicating Directory Changes" e la
+    ricerca parte dalla radice del dominio. Gli utenti cambiati nelle OU
+    configurate vengono poi riletti per DN con find_users_by_dn().
+
+    Vengono chiesti solo gli attributi usati dai template: il DC segnala
+    così soltanto le modifiche che cambiano una firma (uSNChanged non è
+    replicato e DirSync non lo riporterebbe mai). Senza un cookie salvato
+    il primo giro serve solo a ottenerne uno: il dominio viene letto una
+    volta ma nessuna firma viene ridistribuita.
+    """
+
+    name = 'DirSync'
+
+    def __init__(self, manager, search_filter, search_bases):
+        self.manager = manager
+        self.search_filter = search_filter
+        self.search_bases = list(search_bases)
+        self.roots = sorted({domain_of(base) for base in self.search_bases})
+        self._cookies = {}
+
+    def _state_key(self, root):
+        return f"{self.manager.connection.server.host}|{root}"
+
+    def attributes(self):
+        """Attributi replicati che, se cambiano, cambiano la firma"""
+        attributes = [attribute for attribute in self.manager.template_attributes() if attribute != 'uSNChanged']
+        enricher = self.manager.get_enricher()
+        if enricher:
+            attributes += enricher.user_attributes()
+        return attributes
+
+    def poll(self):
+        """Utenti modificati dal cookie precedente (al primo avvio: nessuno)"""
+        changed = set()
+        attributes = self.attributes()
+        for root in self.roots:
+            cookie = self._cookies.get(root)
+            if cookie is None:
+                saved = self.manager.state.get('dirsync', self._state_key(root))
+                cookie = base64.b64decode(saved) if saved else None
+            baseline = cookie is None
+            if baseline:
+                print(f"→ DirSync: primo avvio su {root}, lettura dello stato iniziale")
+            sync = self.manager.connection.extend.microsoft.dir_sync(
+                root, '(objectClass=user)', attributes=attributes, cookie=cookie)
+            while True:
+                for entry in sync.loop():
+                    if baseline or entry.get('type') != 'searchResEntry':
+                        continue
+                    # Con l'extended DN control il DN è <GUID=...>;<SID=...>;CN=...
+                    dn = entry['dn'].rsplit('>;', 1)[-1]
+                    if any(is_under(dn, base) for base in self.search_bases):
+                        changed.add(dn)
+                if not sync.more_results:
+                    break
+            self._cookies[root] = sync.cookie
+            if baseline and sync.cookie:
+                # Nessuna modifica in sospeso: il cookie iniziale si può salvare subito
+                self._store_cookie(root, sync.cookie)
+                try:
+                    self.manager.state.save()
+                except OSError as e:
+                    print(f"⚠ Impossibile salvare il file di stato: {e}")
+        return self.manager.find_users_by_dn(changed, self.search_filter) if changed else []
+
+    def _store_cookie(self, root, cookie):
+        self.manager.state.set('dirsync', self._state_key(root), base64.b64encode(cookie).decode('ascii'))
+
+    def commit(self):
+        for root, cookie in self._cookies.items():
+            if cookie:
+                self._store_cookie(root, cookie)
+        self.manager.state.save()
+
+
+class SignatureWatcher:
+    """
+    Daemon: tiene una connessione ad AD e ridistribuisce le firme degli utenti modificati
+
+    Le modifiche lette dalla sorgente (DirSync o uSNChanged) vengono
+    raggruppate: la distribuzione parte quando non arrivano nuove modifiche
+    da debounce secondi, o al più tardi dopo max_delay secondi dalla prima,
+    così una raffica di modifiche diventa un solo batch. Gli utenti ancora
+    in coda dopo una distribuzione (errori) vengono salvati nel file di
+    stato insieme alla posizione della sorgente e ripresi al riavvio.
+    """
+
+    def __init__(self, manager, source, output_folder=None, interval=DEFAULT_WATCH_INTERVAL,
+                 debounce=DEFAULT_WATCH_DEBOUNCE, max_delay=DEFAULT_WATCH_MAX_DELAY,
+                 max_workers=DEFAULT_DEPLOY_WORKERS):
+        self.manager = manager
+        self.source = source
+        self.output_folder = output_folder
+        self.interval = interval
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.max_workers = max_workers
+        self.pending = {}
+        self.deployed = 0
+        self.failed = 0
+        self._first_change = None
+        self._last_change = None
+        self._stop = threading.Event()
+
+    def stop(self):
+        """Termina run() al prossimo controllo (anche da un altro thread)"""
+        self._stop.set()
+
+    def add_changes(self, users):
+        """Mette in coda utenti modificati (l'ultima versione di ogni utente vince)"""
+        if not users:
+            return
+        now = time.monotonic()
+        for user in users:
+            self.pending[(user['username'] or user['dn']).lower()] = user
+        self._last_change = now
+        if self._first_change is None:
+            self._first_change = now
+
+    def restore_pending(self):
+        """Rimette in coda gli utenti rimasti in sospeso nell'esecuzione precedente"""
+        dns = self.manager.state.get('watch', 'pending') or []
+        if dns:
+            users = self.manager.find_users_by_dn(dns, self.source.search_filter)
+            print(f"→ {len(users)} utenti in sospeso dall'esecuzione precedente")
+            self.add_changes(users)
+
+    def due(self, now=None):
+        """True se le modifiche in coda vanno distribuite adesso"""
+        if not self.pending:
+            return False
+        now = time.monotonic() if now is None else now
+        return now - self._last_change >= self.debounce or now - self._first_change >= self.max_delay
+
+    def flush(self):
+        """Distribuisce le firme in coda; gli utenti con errori restano in coda"""
+        users = list(self.pending.values())
+        self.pending.clear()
+        self._first_change = self._last_change = None
+
+        print(f"→ {datetime.now():%H:%M:%S} aggiornamento firme di {len(users)} utenti")
+        results = self.manager.deploy_batch(users, self.output_folder, max_workers=self.max_workers)
+        self.manager.finish_writes()
+        failed = [user for user, result in zip(users, results) if not result.ok]
+        self.deployed += len(users) - len(failed)
+        self.failed += len(failed)
+        self.add_changes(failed)
+        # Salvati insieme alla posizione della sorgente, che va oltre le loro modifiche
+        self.manager.state.set('watch', 'pending', sorted(user['dn'] for user in self.pending.values()))
+        try:
+            self.source.commit()
+        except OSError as e:
+            print(f"⚠ Impossibile salvare il file di stato: {e}")
+
+    def run(self, max_cycles=None):
         """
-        Genera firma HTML per un utente
-        
+        Ciclo principale: controlla le modifiche ogni interval secondi finché stop()
+
         Args:
-            user: Dizionario con dati utente
-        
-        Returns:
-            Stringa HTML della firma
+            max_cycles: Numero massimo di controlli (None = senza limite)
         """
-        mobile_html = ""
-        if user['mobile']:
-            mobile_html = f"Mobile: {user['mobile']}<br>"
-        
-        html = f"""<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <meta name="Generator" content="AD-Outlook Signature Manager">
-</head>
-<body style="margin: 0; padding: 0; font-family: Arial, Helvetica, sans-serif;">
-    <table cellpadding="0" cellspacing="0" border="0" style="font-family: Arial, Helvetica, sans-serif; font-size: 13px; line-height: 1.6; color: #333; max-width: 600px;">
-        <tr>
-            <td style="padding: 0; vertical-align: top;">
-                <!-- Nome e Ruolo -->
-                <div style="margin-bottom: 10px;">
-                    <strong style="font-size: 15px; color: #000; font-weight: bold;">
-                        {user['display_name'].replace('(..........)', '').replace('(Carton Group)', '').strip()}
-                    </strong><br>
-                    <span style="font-size: 13px; color: #333;">
-                        {user['title']}
-                    </span>
-                </div>
-                
-                <!-- Informazioni Azienda -->
-                <div style="margin-bottom: 10px; padding-bottom: 10px;">
-                    <strong style="font-size: 13px; color: #000;">
-                        Your Company
-                    </strong><br>
-                    <span style="font-size: 12px; color: #333;">
-                        Address
-                    </span>
-                </div>
-                
-                <!-- Contatti -->
-                <div style="margin-bottom: 15px; font-size: 12px; color: #333;">
-                    Tel: {user['phone']}<br>
-                    {mobile_html}Mail: <a href="mailto:{user['email']}" style="color: #0066cc; text-decoration: none;">{user['email']}</a>
-                </div>
-                
-                <!-- Logo -->
-                <div style="margin-bottom: 15px; max-width: 10px; height:10px; display:flex">
-                    <img src="...." alt="Gruppo">
-                </div>
-                
-                <!-- Loghi Vari
-                <div style="margin-bottom: 15px;">
-                    <table cellpadding="0" cellspacing="0" border="0">
-                        <tr>
-                            <td style="padding-right: 20px;">
-                                <img src="https://via.placeholder.com/150x50/1a1a1a/ffffff?text=Carton+Group" alt="..." style="max-width: 150px; height: auto; display: block;">
-                            </td>
-                            <td>
-                                <img src="https://via.placeholder.com/150x80/1a1a1a/ffffff?text=Beyond+Packaging" alt="..." style="max-width: 150px; height: auto; display: block;">
-                            </td>
-                        </tr>
-                    </table>
-                </div>
-		-->
-                
-                <!-- Link Siti Web -->
-                <div style="margin-bottom: 10px; font-size: 12px;">
-                    <a href="https://www.google.it/" style="color: #0066cc; text-decoration: none;">www.google.it/</a> | 
-                    <a href="https://www.google.com/" style="color: #0066cc; text-decoration: none;">www.google.com/</a>
-                </div>
-                
-                <!-- Social Links -->
-                <div style="margin-bottom: 15px; font-size: 12px;">
-                    Follow us: 
-                    <a href="https://www.linkedin.com/company/google" style="color: #0066cc; text-decoration: none;">google</a> | 
-                    <a href="https://www.linkedin.com/company/google" style="color: #0066cc; text-decoration: none;">LinkedIn</a>
-                </div>
-                
-                <!-- Disclaimer -->
-                <div style="margin-top: 15px; padding-top: 10px; border-top: 1px solid #cccccc; font-size: 9px; color: #666; line-height: 1.3;">
-                    This e-mail may contain confidential and/or privileged information. If you are not the intended recipient (or have received this e-mail in error) please notify the sender immediately and destroy this e-mail. Any unauthorized copying, disclosure or distribution of the material in this e-mail is strictly forbidden.
-                </div>
-            </td>
-        </tr>
-    </table>
-</body>
-</html>"""
-        
-        return html
-    
-    def generate_signature_txt(self, user):
-        """Genera firma in formato testo"""
-        mobile_txt = f"\nMobile: {user['mobile']}" if user['mobile'] else ""
-        
-        txt = f"""{user['display_name'].replace('(Europoligrafico)', '').replace('(Carton Group)', '').strip()}
-{user['title']}
+        print(f"→ In ascolto delle modifiche ({self.source.name}, ogni {self.interval}s)")
+        restored = False
+        cycles = 0
+        while not self._stop.is_set():
+            try:
+                if not restored:
+                    self.restore_pending()
+                    restored = True
+                self.add_changes(self.source.poll())
+            except LDAPException as e:
+                # Connessione caduta o DC non disponibile: nuovo bind (eventualmente su un altro DC)
+                print(f"⚠ Controllo modifiche fallito: {e}")
+                self.manager.connect_to_ad()
 
-Your Company
-Your Address
+            if self.due():
+                self.flush()
 
-Tel: {user['phone']}{mobile_txt}
-Mail: {user['email']}
+            cycles += 1
+            if max_cycles is not None and cycles >= max_cycles:
+                break
+            wait = self.interval
+            if self.pending:
+                wait = min(wait, max(0.1, self._last_change + self.debounce - time.monotonic()))
+            self._stop.wait(wait)
 
-www.google.it/ | www.google.com/
-Follow us: google | LinkedIn
+        if self.pending:
+            self.flush()
 
-This e-mail may contain confidential and/or privileged information. If you are not the intended recipient (or have received this e-mail in error) please notify the sender immediately and destroy this e-mail. Any unauthorized copying, disclosure or distribution of the material in this e-mail is strictly forbidden."""
-        
-        return txt
-    
-    def deploy_signature_to_user(self, user, target_username=None):
+
+# Servizio HTTP delle firme (--serve)
+DEFAULT_LISTEN = '127.0.0.1:8080'
+SNAPSHOT_CHECK_INTERVAL = 5  # secondi tra due controlli di modifica dello snapshot
+SIGNATURE_CONTENT_TYPES = {
+    'html': 'text/html; charset=utf-8',
+    'txt': 'text/plain; charset=utf-8',
+}
+
+
+class SignatureService:
+    """
+    Firme HTML/TXT servite via HTTP a partire dallo snapshot degli utenti
+
+    Gli utenti dello snapshot vengono indicizzati in memoria per username ed
+    email; lo snapshot viene riletto quando il file cambia. Ogni risposta
+    generata resta in una cache LRU insieme al suo ETag, così le richieste
+    con If-None-Match ricevono un 304 senza rigenerare né trasferire la firma.
+    È l'unica cache delle firme: quella del manager va disattivata
+    (RenderCache(0)) per non tenere ogni firma due volte in memoria.
+
+    Endpoint:
+        GET /signature/<username o email>.html|.txt
+        GET /metrics   (formato Prometheus)
+        GET /health
+    """
+
+    def __init__(self, manager, snapshot_path=SNAPSHOT_FILE, search_bases=None,
+                 cache_size=DEFAULT_RENDER_CACHE_SIZE):
+        self.manager = manager
+        self.snapshot_path = Path(snapshot_path)
+        self.search_bases = list(search_bases or [])
+        self.responses = RenderCache(cache_size)
+        self.users = {}
+        self.user_count = 0
+        self._mtime = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        """Ricostruisce l'indice degli utenti dallo snapshot"""
+        mtime = self.snapshot_path.stat().st_mtime if self.snapshot_path.exists() else None
+        snapshot = UserSnapshot(self.snapshot_path)
+        try:
+            users = {}
+            count = 0
+            for user in snapshot.iter_users(self.search_bases or None):
+                count += 1
+                for key in (user['username'], user['email']):
+                    if key:
+                        users[key.lower()] = user
+        finally:
+            snapshot.close()
+        self.users = users
+        self.user_count = count
+        self._mtime = mtime
+        self.responses.clear()
+        print(f"✓ {count} utenti caricati dallo snapshot {self.snapshot_path}")
+
+    def _reload_if_changed(self):
+        now = time.monotonic()
+        if now - self._checked < SNAPSHOT_CHECK_INTERVAL:
+            return
+        with self._lock:
+            if now - self._checked < SNAPSHOT_CHECK_INTERVAL:
+                return
+            self._checked = now
+            try:
+                mtime = self.snapshot_path.stat().st_mtime
+            except OSError:
+                return
+            if mtime != self._mtime:
+                self.reload()
+
+    def signature(self, key, fmt):
         """
-        Distribuisce la firma per un utente specifico
-        
+        Firma di un utente pronta da inviare
+
         Args:
-            user: Dizionario con dati utente
-            target_username: Username Windows (default: username AD dell'utente)
-        
+            key: Username o email
+            fmt: 'html' o 'txt'
+
         Returns:
-            True se successo, False altrimenti
+            Tupla (etag, corpo in byte), None se l'utente non è nello snapshot
         """
-        if not target_username:
-            target_username = user['username']
-        
-        # Percorso firma Outlook
-        signature_folder = Path(f"C:\\Users\\{target_username}\\AppData\\Roaming\\Microsoft\\Signatures")
-        
-        # Crea cartella se non esiste
+        self._reload_if_changed()
+        user = self.users.get(key.lower())
+        if user is None:
+            return None
+        cache_key = (fmt, user)
+        response = self.responses.get(cache_key)
+        if response is None:
+            if fmt == 'html':
+                content = self.manager.generate_signature_html(user)
+            else:
+                content = self.manager.generate_signature_txt(user)
+            response = (f'"{content_hash(content)[:32]}"', content.encode('utf-8'))
+            self.responses.put(cache_key, response)
+        return response
+
+    def metrics_text(self):
+        """Metriche delle richieste e della cache nel formato di Prometheus"""
+        lines = [self.manager.metrics.prometheus_text().rstrip('\n')]
+        stats = self.responses.stats()
+        for field in ('hits', 'misses', 'size'):
+            kind = 'gauge' if field == 'size' else 'counter'
+            name = f"{METRICS_PREFIX}_response_cache_{field}" + ('_total' if kind == 'counter' else '')
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {stats[field]}")
+        # Utenti distinti: self.users ha una chiave per username e una per email
+        lines.append(f"# TYPE {METRICS_PREFIX}_snapshot_users gauge")
+        lines.append(f"{METRICS_PREFIX}_snapshot_users {self.user_count}")
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, host='127.0.0.1', port=8080, quiet=False):
+        """Avvia il server HTTP (bloccante, termina con Ctrl+C)"""
+        server = ThreadingHTTPServer((host, port), _SignatureRequestHandler)
+        server.daemon_threads = True
+        server.service = self
+        server.quiet = quiet
+        print(f"→ Firme disponibili su http://{host}:{server.server_port}/signature/<utente>.html")
         try:
-            signature_folder.mkdir(parents=True, exist_ok=True)
-        except Exception as e:
-            print(f"✗ Errore creazione cartella firma per {user['display_name']}: {e}")
-            return False
-        
-        # Nome file firma
-        signature_name = f"Firma-{self.company_info['nome'].replace(' ', '-')}"
-        
-        # Genera e salva firma HTML
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("\n→ Interruzione richiesta")
+        finally:
+            server.server_close()
+
+
+def _etag_matches(header, etag):
+    """True se l'header If-None-Match contiene etag (o '*')"""
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == etag:
+            return True
+    return False
+
+
+class _SignatureRequestHandler(BaseHTTPRequestHandler):
+    """Richieste HTTP di SignatureService (self.server.service)"""
+
+    server_version = 'ADSignatureService'
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        start = time.perf_counter()
+        service = self.server.service
+        path = unquote(urlsplit(self.path).path)
+
+        if path == '/health':
+            self._send(200, b'ok\n', 'text/plain; charset=utf-8')
+            return
+        if path == '/metrics':
+            self._send(200, service.metrics_text().encode('utf-8'), 'text/plain; version=0.0.4; charset=utf-8')
+            return
+
+        key, _, fmt = path.removeprefix('/signature/').rpartition('.')
+        if not path.startswith('/signature/') or not key or fmt not in SIGNATURE_CONTENT_TYPES:
+            self._send(404, b'not found\n', 'text/plain; charset=utf-8')
+            service.manager.metrics.observe('http_not_found', time.perf_counter() - start)
+            return
+
         try:
-            html_content = self.generate_signature_html(user)
-            html_file = signature_folder / f"{signature_name}.htm"
-            html_file.write_text(html_content, encoding='utf-8')
-            print(f"  ✓ Salvata firma HTML: {html_file}")
+            response = service.signature(key, fmt)
         except Exception as e:
-            print(f"  ✗ Errore salvataggio HTML: {e}")
-            return False
-        
-        # Genera e salva firma TXT
+            self._send(500, f"{e}\n".encode('utf-8'), 'text/plain; charset=utf-8')
+            service.manager.metrics.observe('http_signature', time.perf_counter() - start, 0, 0, 1)
+            return
+        if response is None:
+            self._send(404, b'utente non trovato\n', 'text/plain; charset=utf-8')
+            service.manager.metrics.observe('http_not_found', time.perf_counter() - start)
+            return
+
+        etag, body = response
+        if _etag_matches(self.headers.get('If-None-Match', ''), etag):
+            self._send(304, b'', etag=etag)
+            service.manager.metrics.observe('http_not_modified', time.perf_counter() - start)
+            return
+        self._send(200, body, SIGNATURE_CONTENT_TYPES[fmt], etag=etag)
+        service.manager.metrics.observe('http_signature', time.perf_counter() - start, 1, len(body))
+
+    def _send(self, status, body, content_type=None, etag=None):
+        self.send_response(status)
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        if status != 304:
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def load_settings(module_name='config'):
+    """
+    Legge la configurazione da config.py (vedi config_example.py)
+
+    Le chiavi non definite in config.py mantengono i valori di DEFAULT_SETTINGS.
+
+    Returns:
+        Dizionario con AD_SERVER, DOMAIN, BASE_DN, SEDI, COMPANY_INFO, PROFILES_ROOT e i timeout
+    """
+    settings = copy.deepcopy(DEFAULT_SETTINGS)
+    try:
+        config = importlib.import_module(module_name)
+    except ImportError:
+        return settings
+    for key in settings:
+        if hasattr(config, key):
+            settings[key] = getattr(config, key)
+    return settings
+
+
+def create_manager(settings, username, password, base_dn=None, metrics=None, render_cache=None, quiet=False,
+                   registry=None):
+    """
+    Crea un ADSignatureManager dalla configurazione di load_settings()
+
+    Args:
+        settings: Configurazione
+        username: Username AD (None se non serve collegarsi)
+        password: Password
+        base_dn: Base DN della ricerca (default: BASE_DN della configurazione)
+        metrics: Metrics condiviso in cui registrare i tempi (default: uno nuovo)
+        render_cache: RenderCache condivisa delle firme generate (default: una nuova)
+        quiet: Non stampare un messaggio per ogni file/utente
+        registry: Registro della firma predefinita, es. MemoryRegistry per
+            provare la configurazione (default: winreg se disponibile)
+    """
+    manager = ADSignatureManager(settings['AD_SERVER'], settings['DOMAIN'], base_dn or settings['BASE_DN'],
+                                 username, password,
+                                 profiles_root=settings['PROFILES_ROOT'],
+                                 connect_timeout=settings['CONNECT_TIMEOUT'],
+                                 receive_timeout=settings['RECEIVE_TIMEOUT'])
+    manager.company_info.update(settings['COMPANY_INFO'])
+    manager.branding = BrandingRegistry.from_settings(settings, manager.template_dir, manager.company_info)
+    if settings['ASSETS']:
+        manager.assets = AssetStore({name: _local_path(path) for name, path in settings['ASSETS'].items()},
+                                    settings['ASSET_MODE'], f"{manager.signature_name()}_files")
+    manager.excluded_ous = list(settings['EXCLUDED_OUS'])
+    manager.group_prefix = settings['GROUP_PREFIX']
+    manager.office_version = settings['OFFICE_VERSION']
+    manager.reg_file = settings['REG_FILE']
+    manager.defaults_manifest = settings['DEFAULTS_MANIFEST']
+    if registry is not None:
+        manager.registry = registry
+    if not settings['SET_DEFAULT_SIGNATURE']:
+        manager.registry = None
+    if metrics is not None:
+        manager.metrics = metrics
+    if render_cache is not None:
+        manager.render_cache = render_cache
+    manager.quiet = quiet
+    return manager
+
+
+def read_credentials(credentials_file=None):
+    """
+    Legge le credenziali AD per l'esecuzione non interattiva
+
+    Il file credenziali contiene righe CHIAVE=valore (AD_USERNAME, AD_PASSWORD);
+    i valori mancanti vengono presi dalle variabili d'ambiente omonime.
+
+    Returns:
+        Tupla (username, password); None per i valori non trovati
+    """
+    values = {}
+    if credentials_file:
+        for line in Path(credentials_file).read_text(encoding='utf-8').splitlines():
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            values[key.strip()] = value.strip().strip('"\'')
+    username = values.get('AD_USERNAME') or os.environ.get('AD_USERNAME')
+    password = values.get('AD_PASSWORD') or os.environ.get('AD_PASSWORD')
+    return username, password
+
+
+def build_search_filter(search_query='', contains=False, exclude_disabled=True, require_mail=True,
+                        search_attributes=SEARCH_TEXT_ATTRIBUTES):
+    """
+    Filtro LDAP per la ricerca utenti
+
+    Tutte le esclusioni vengono valutate dal DC, così le entry scartate non
+    vengono trasferite. Il testo cercato è escapato secondo RFC 4515 e di
+    default confrontato come prefisso (testo*), che AD risolve con gli indici;
+    con contains il confronto è *testo*, che richiede una scansione.
+
+    Args:
+        search_query: Testo da cercare in username, nome, cognome, nome completo o email
+        contains: Cerca il testo in qualsiasi posizione invece che all'inizio
+        exclude_disabled: Esclude gli account disabilitati (userAccountControl)
+        require_mail: Solo utenti con un indirizzo email
+        search_attributes: Attributi in cui cercare il testo
+
+    Returns:
+        Stringa del filtro LDAP
+    """
+    terms = [USER_ACCOUNT_FILTER]
+    if require_mail:
+        terms.append('(mail=*@*)')
+    if exclude_disabled:
+        terms.append(f'(!{DISABLED_ACCOUNT_FILTER})')
+    search_query = search_query.strip()
+    if search_query:
+        value = escape_filter_chars(search_query)
+        pattern = f'*{value}*' if contains else f'{value}*'
+        terms.append('(|' + ''.join(f'({attribute}={pattern})' for attribute in search_attributes) + ')')
+    return f"(&{''.join(terms)})"
+
+
+def run_incremental_sync(manager, ldap_filter, search_bases=None, output_folder=None, full=False,
+                         max_workers=DEFAULT_DEPLOY_WORKERS):
+    """
+    Rigenera le firme solo per gli utenti modificati dall'ultima esecuzione
+
+    Args:
+        manager: ADSignatureManager già connesso
+        ldap_filter: Filtro LDAP di base
+        search_bases: Lista di Base DN da sincronizzare (default: manager.base_dn)
+        output_folder: Se indicata salva le firme qui, altrimenti le distribuisce nei profili
+        full: Ignora gli high-water mark e rigenera tutto
+        max_workers: Numero di thread di scrittura
+
+    Returns:
+        Tupla (firme aggiornate, errori)
+    """
+    users = manager.search_changed_users(ldap_filter, full=full, search_bases=search_bases)
+
+    results = manager.deploy_batch(users, output_folder, max_workers=max_workers)
+    updated = sum(1 for r in results if r.ok)
+    errors = len(results) - updated
+
+    manager.finish_writes()
+    
+    # Avanza gli high-water mark solo se tutte le firme sono andate a buon fine,
+    # altrimenti al prossimo giro gli stessi utenti vengono riprovati
+    if errors == 0:
+        manager.commit_sync_state()
+    else:
+        print(f"⚠ {errors} errori: stato di sincronizzazione non aggiornato")
+
+    print(f"\n✓ Sincronizzazione incrementale: {updated} firme aggiornate, {errors} errori")
+    return updated, errors
+
+
+def resolve_search_bases(settings, sede=None, ous=None):
+    """
+    Determina le OU da interrogare in modalità batch
+
+    Args:
+        settings: Configurazione da load_settings()
+        sede: Chiavi di SEDI separate da virgola, oppure 'tutte'
+        ous: Lista di Base DN espliciti
+
+    Returns:
+        Dizionario {nome: Base DN}
+    """
+    if ous:
+        return {ou: ou for ou in ous}
+    sedi = settings['SEDI']
+    if not sede:
+        return {'Tutte': settings['BASE_DN']}
+    if sede.strip().lower() == 'tutte':
+        keys = list(sedi)
+    else:
+        keys = [key.strip() for key in sede.split(',') if key.strip()]
+    unknown = [key for key in keys if key not in sedi]
+    if unknown:
+        raise ValueError(f"Sede non configurata: {', '.join(unknown)}")
+    return {sedi[key]['nome']: sedi[key]['ou'] for key in keys}
+
+
+def run_batch(args, settings):
+    """
+    Esecuzione non interattiva (scheduler): cerca, genera e distribuisce le firme
+
+    I messaggi di avanzamento vanno su stderr; il riepilogo JSON viene
+    restituito al chiamante che lo scrive su stdout.
+
+    Returns:
+        Tupla (riepilogo, exit code: 0 ok, 1 errori di scrittura, 2 errore di configurazione/AD)
+    """
+    summary = {
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'dry_run': args.dry_run,
+        'incremental': args.incremental,
+        'output': args.archive or args.output or settings['PROFILES_ROOT'],
+        'search_bases': {},
+        'users': 0,
+        'deployed': 0,
+        'failed': 0,
+        'files': {},
+        'errors': [],
+    }
+    metrics = Metrics()
+    render_cache = RenderCache(args.render_cache)
+    start = time.perf_counter()
+    try:
+        exit_code = _run_batch(args, settings, summary, metrics, render_cache)
+    except Exception as e:
+        # Anche un errore imprevisto deve arrivare allo scheduler come riepilogo ed exit code
+        traceback.print_exc()
+        summary['errors'].append(f"Errore imprevisto: {e.__class__.__name__}: {e}")
+        exit_code = 2
+    summary['elapsed'] = round(time.perf_counter() - start, 3)
+    summary['metrics'] = metrics.snapshot()
+    summary['render_cache'] = render_cache.stats()
+    if args.metrics:
         try:
-            txt_content = self.generate_signature_txt(user)
-            txt_file = signature_folder / f"{signature_name}.txt"
-            txt_file.write_text(txt_content, encoding='utf-8')
-            print(f"  ✓ Salvata firma TXT: {txt_file}")
-        except Exception as e:
-            print(f"  ✗ Errore salvataggio TXT: {e}")
-            return False
-        
-        # Imposta firma come predefinita nel registro (opzionale)
+            metrics.export(args.metrics, args.metrics_format)
+        except OSError as e:
+            summary['errors'].append(f"Metriche non salvate in {args.metrics}: {e}")
+    summary['exit_code'] = exit_code
+    return summary, exit_code
+
+
+def _run_batch(args, settings, summary, metrics, render_cache):
+    """Corpo di run_batch(): aggiorna summary e restituisce l'exit code"""
+    try:
+        search_bases = resolve_search_bases(settings, args.sede, args.ou)
+    except ValueError as e:
+        summary['errors'].append(str(e))
+        return 2
+    summary['search_bases'] = search_bases
+
+    if args.from_snapshot:
+        # Rendering dallo snapshot locale, senza collegarsi ad AD
+        if args.incremental:
+            summary['errors'].append("--from-snapshot non è compatibile con --incremental")
+            return 2
+        if not Path(args.snapshot).is_file():
+            summary['errors'].append(f"Snapshot non trovato: {args.snapshot}")
+            return 2
+        snapshot = UserSnapshot(args.snapshot, args.snapshot_ttl)
+        stale = [name for name, base in search_bases.items() if not snapshot.is_fresh(base)]
+        if stale:
+            summary['errors'].append(f"Snapshot assente o scaduto per: {', '.join(stale)}")
+            return 2
+        manager = create_manager(settings, None, None, metrics=metrics, render_cache=render_cache,
+                                 quiet=args.quiet)
+        users = list(snapshot.iter_users(list(search_bases.values()), args.filter))
+        return deploy_batch_users(manager, users, args, summary)
+
+    username, password = read_credentials(args.credentials_file)
+    if not username or not password:
+        summary['errors'].append("Credenziali mancanti: usa AD_USERNAME/AD_PASSWORD o --credentials-file")
+        return 2
+
+    manager = create_manager(settings, username, password, metrics=metrics, render_cache=render_cache,
+                             quiet=args.quiet)
+
+    if not manager.connect_to_ad():
+        summary['errors'].append(f"Connessione ad AD fallita: {settings['AD_SERVER']}")
+        return 2
+
+    ldap_filter = build_search_filter(args.filter, contains=args.contains,
+                                      exclude_disabled=settings['EXCLUDE_DISABLED'] and not args.include_disabled)
+    if args.minimal_attributes or args.pipeline:
+        manager.search_attributes = manager.template_attributes()
+
+    if args.pipeline:
+        # Ricerca, generazione e scrittura sovrapposte, senza tenere tutti gli utenti in memoria
+        pipeline = SignaturePipeline(manager, ldap_filter, search_bases.values(), args.output,
+                                     writers=args.workers, dry_run=args.dry_run)
+        result = pipeline.run()
+        if not args.output and not args.dry_run and result['deployed']:
+            manager.apply_default_signature(result['deployed_users'])
+        summary['files'] = manager.finish_writes()
+        summary['users'] = result['deployed'] + result['failed']
+        summary['deployed'] = result['deployed']
+        summary['failed'] = result['failed']
+        summary['errors'].extend(result['search_errors'] + result['errors'])
+        summary['stages'] = result['stages']
+        if result['search_errors']:
+            return 2
+        return 1 if result['failed'] else 0
+
+    try:
+        if args.incremental:
+            users = manager.search_changed_users(ldap_filter, full=args.full,
+                                                 search_bases=list(search_bases.values()))
+        else:
+            users, latencies = manager.search_multiple_ous(search_bases, ldap_filter,
+                                                           max_connections=min(len(search_bases), DEFAULT_POOL_SIZE))
+            summary['latencies'] = {name: round(sec, 3) for name, sec in latencies.items()}
+            missing = [name for name in search_bases if name not in latencies]
+            if missing:
+                summary['errors'].append(f"Ricerca fallita per: {', '.join(missing)}")
+                return 2
+    except Exception as e:
+        summary['errors'].append(f"Ricerca fallita: {e}")
+        return 2
+
+    # Con i soli attributi dei template lo snapshot resterebbe incompleto
+    if manager.search_attributes is USER_ATTRIBUTES:
         try:
-            import winreg
-            reg_path = r"Software\Microsoft\Office\16.0\Common\MailSettings"
-            key = winreg.CreateKey(winreg.HKEY_CURRENT_USER, reg_path)
-            winreg.SetValueEx(key, "NewSignature", 0, winreg.REG_SZ, signature_name)
-            winreg.SetValueEx(key, "ReplySignature", 0, winreg.REG_SZ, signature_name)
-            winreg.CloseKey(key)
-            print(f"  ✓ Firma impostata come predefinita in Outlook")
-        except Exception as e:
-            print(f"  ⚠ Avviso: Non è stato possibile impostare la firma come predefinita: {e}")
-        
-        return True
-    
-    def save_signature_to_file(self, user, output_folder="./firme"):
-        """
-        Salva la firma in una cartella locale (per distribuzione manuale)
-        
-        Args:
-            user: Dizionario con dati utente
-            output_folder: Cartella dove salvare le firme
-        """
-        output_path = Path(output_folder)
-        output_path.mkdir(exist_ok=True)
-        
-        user_folder = output_path / user['username']
-        user_folder.mkdir(exist_ok=True)
-        
-        # Salva HTML
-        html_content = self.generate_signature_html(user)
-        html_file = user_folder / "firma.htm"
-        html_file.write_text(html_content, encoding='utf-8')
-        
-        # Salva TXT
-        txt_content = self.generate_signature_txt(user)
-        txt_file = user_folder / "firma.txt"
-        txt_file.write_text(txt_content, encoding='utf-8')
-        
-        print(f"✓ Firma salvata in: {user_folder}")
-        return str(user_folder)
+            snapshot = UserSnapshot(args.snapshot, args.snapshot_ttl)
+            try:
+                update_snapshot(snapshot, users, search_bases.values(), complete=not (args.filter or args.incremental))
+            finally:
+                snapshot.close()
+        except (sqlite3.Error, OSError) as e:
+            # Le firme vengono distribuite comunque: lo snapshot serve solo alle esecuzioni successive
+            summary['errors'].append(f"Snapshot non aggiornato ({args.snapshot}): {e}")
+            return max(deploy_batch_users(manager, users, args, summary), 1)
+    return deploy_batch_users(manager, users, args, summary)
 
 
-def display_users(users):
-    """Mostra lista utenti in formato tabella"""
-    if not users:
-        print("Nessun utente trovato.")
-        return
-    
-    print("\n" + "="*100)
-    print(f"{'#':<4} {'Username':<15} {'Nome Completo':<30} {'Email':<35}")
-    print("="*100)
-    
-    for idx, user in enumerate(users, 1):
-        print(f"{idx:<4} {user['username']:<15} {user['display_name']:<30} {user['email']:<35}")
+def deploy_batch_users(manager, users, args, summary):
+    """Seconda fase di run_batch(): genera e distribuisce le firme degli utenti trovati"""
+    summary['users'] = len(users)
+
+    if args.dry_run:
+        # Genera le firme senza scrivere nulla, per validare template e dati
+        for user in users:
+            try:
+                manager.generate_signature_html(user)
+                manager.generate_signature_txt(user)
+                summary['deployed'] += 1
+            except Exception as e:
+                summary['failed'] += 1
+                summary['errors'].append(f"{user['username']}: {e}")
+        return 1 if summary['failed'] else 0
+
+    if args.archive:
+        try:
+            results = manager.export_archive(users, args.archive, with_manifest=args.archive_manifest,
+                                             processes=args.processes)
+        except OSError as e:
+            summary['errors'].append(f"Archivio non creato: {e}")
+            return 1
+        summary['archive'] = args.archive
+    else:
+        results = manager.deploy_batch(users, args.output, max_workers=args.workers, processes=args.processes)
+        summary['files'] = manager.finish_writes()
+    summary['deployed'] = sum(1 for r in results if r.ok)
+    summary['failed'] = len(results) - summary['deployed']
+    summary['errors'].extend(f"{r.username}: {r.error}" for r in results if not r.ok)
+
+    if args.incremental and summary['failed'] == 0:
+        manager.commit_sync_state()
+
+    return 1 if summary['failed'] else 0
+
+
+def create_change_source(manager, mode, search_filter, search_bases):
+    """
+    Sceglie la sorgente delle modifiche per --watch
+
+    Con mode 'auto' prova DirSync e, se l'account non ha i permessi di
+    replica o il server non supporta il controllo, ripiega sul polling di
+    uSNChanged.
+
+    Returns:
+        Tupla (sorgente, utenti già modificati trovati durante la verifica di DirSync)
+    """
+    if mode == 'poll':
+        return UsnChangeSource(manager, search_filter, search_bases), []
+    source = DirSyncChangeSource(manager, search_filter, search_bases)
+    if mode == 'dirsync':
+        return source, []
+    supported = manager.connection.server.info and manager.connection.server.info.supported_controls
+    if supported and not any(control[0] == DIRSYNC_OID for control in supported):
+        print("⚠ DirSync non supportato dal server: uso il polling di uSNChanged")
+        return UsnChangeSource(manager, search_filter, search_bases), []
+    try:
+        # Primo giro subito: verifica i permessi e mette da parte le modifiche già pendenti
+        initial = source.poll()
+    except Exception as e:
+        print(f"⚠ DirSync non disponibile ({e}): uso il polling di uSNChanged")
+        return UsnChangeSource(manager, search_filter, search_bases), []
+    return source, initial
+
+
+def run_watch(args, settings):
+    """
+    Daemon (--watch): ridistribuisce le firme quando gli utenti cambiano in AD
+
+    Returns:
+        Exit code: 0 terminato normalmente, 2 errore di configurazione/AD
+    """
+    try:
+        search_bases = resolve_search_bases(settings, args.sede, args.ou)
+    except ValueError as e:
+        print(f"✗ {e}")
+        return 2
+    username, password = read_credentials(args.credentials_file)
+    if not username or not password:
+        print("✗ Credenziali mancanti: usa AD_USERNAME/AD_PASSWORD o --credentials-file")
+        return 2
+
+    manager = create_manager(settings, username, password, render_cache=RenderCache(args.render_cache),
+                             quiet=True)
+    if not manager.connect_to_ad():
+        return 2
+
+    ldap_filter = build_search_filter(args.filter, contains=args.contains,
+                                      exclude_disabled=settings['EXCLUDE_DISABLED'] and not args.include_disabled)
+    source, initial = create_change_source(manager, args.watch_mode, ldap_filter, list(search_bases.values()))
+    watcher = SignatureWatcher(manager, source, args.output, interval=args.interval,
+                               debounce=args.debounce, max_workers=args.workers)
+    watcher.add_changes(initial)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        print("\n→ Interruzione richiesta")
+        if watcher.pending:
+            watcher.flush()
+    print(f"✓ Firme aggiornate: {watcher.deployed}, errori: {watcher.failed}")
+    return 0
+
+
+def run_serve(args, settings):
+    """
+    Servizio HTTP (--serve): firme generate dallo snapshot locale, senza collegarsi ad AD
+
+    Returns:
+        Exit code: 0 terminato normalmente, 2 errore di configurazione
+    """
+    try:
+        search_bases = resolve_search_bases(settings, args.sede, args.ou) if (args.sede or args.ou) else {}
+    except ValueError as e:
+        print(f"✗ {e}")
+        return 2
+    if not Path(args.snapshot).exists():
+        print(f"✗ Snapshot non trovato: {args.snapshot} (esegui prima una ricerca con --batch)")
+        return 2
+    host, _, port = args.listen.rpartition(':')
+    if not port.isdigit():
+        print(f"✗ Indirizzo non valido: {args.listen} (formato host:porta)")
+        return 2
+
+    # Le firme restano solo nella cache delle risposte del servizio
+    manager = create_manager(settings, None, None, metrics=Metrics(), render_cache=RenderCache(0), quiet=True)
+    service = SignatureService(manager, args.snapshot, search_bases.values(), cache_size=args.render_cache)
+    try:
+        service.serve(host or '127.0.0.1', int(port), quiet=args.quiet)
+    except OSError as e:
+        print(f"✗ Impossibile avviare il server su {args.listen}: {e}")
+        return 2
+    return 0
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Gestore Firme Email: Active Directory -> Outlook")
+    parser.add_argument('--batch', action='store_true',
+                        help="esecuzione non interattiva (scheduler); stampa un riepilogo JSON su stdout")
+    parser.add_argument('--watch', action='store_true',
+                        help="resta in esecuzione e aggiorna le firme degli utenti modificati in AD")
+    parser.add_argument('--watch-mode', choices=('auto', 'dirsync', 'poll'), default='auto',
+                        help="con --watch: notifiche DirSync, polling di uSNChanged o automatico (default)")
+    parser.add_argument('--interval', type=float, default=DEFAULT_WATCH_INTERVAL,
+                        help=f"con --watch: secondi tra due controlli (default: {DEFAULT_WATCH_INTERVAL})")
+    parser.add_argument('--debounce', type=float, default=DEFAULT_WATCH_DEBOUNCE,
+                        help=f"con --watch: secondi senza modifiche prima di distribuire (default: {DEFAULT_WATCH_DEBOUNCE})")
+    parser.add_argument('--serve', action='store_true',
+                        help="servizio HTTP che restituisce le firme dallo snapshot locale (con ETag)")
+    parser.add_argument('--listen', default=DEFAULT_LISTEN,
+                        help=f"con --serve: indirizzo host:porta (default: {DEFAULT_LISTEN})")
+    parser.add_argument('--sede',
+                        help="con --batch: chiavi di SEDI separate da virgola, oppure 'tutte'")
+    parser.add_argument('--ou', action='append',
+                        help="con --batch: Base DN da interrogare (ripetibile, alternativo a --sede)")
+    parser.add_argument('--filter', default='',
+                        help="con --batch: testo iniziale di username, nome, cognome o email")
+    parser.add_argument('--contains', action='store_true',
+                        help="cerca il testo in qualsiasi posizione (più lento: non usa gli indici di AD)")
+    parser.add_argument('--include-disabled', action='store_true',
+                        help="includi gli account disabilitati")
+    parser.add_argument('--exclude-ou', action='append', default=[],
+                        help="ignora gli utenti sotto questo Base DN (ripetibile, si aggiunge a EXCLUDED_OUS)")
+    parser.add_argument('--minimal-attributes', action='store_true',
+                        help="con --batch: chiedi ad AD solo gli attributi usati dai template; "
+                             "lo snapshot non viene aggiornato")
+    parser.add_argument('--workers', type=int, default=DEFAULT_DEPLOY_WORKERS,
+                        help="numero di thread di scrittura")
+    parser.add_argument('--processes', type=int, default=0,
+                        help="genera le firme su questo numero di processi (esportazioni di molti utenti; "
+                             "0 = nel processo principale)")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="con --batch: genera le firme senza scrivere nulla")
+    parser.add_argument('--credentials-file',
+                        help="file con AD_USERNAME=... e AD_PASSWORD=... (default: variabili d'ambiente)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="rigenera solo le firme degli utenti modificati dall'ultima esecuzione")
+    parser.add_argument('--full', action='store_true',
+                        help="con --incremental: ignora lo stato salvato e rigenera tutte le firme")
+    parser.add_argument('--output',
+                        help="salva le firme in questa cartella invece che nei profili utente")
+    parser.add_argument('--archive',
+                        help="esporta tutte le firme in un unico archivio (.zip, .tar, .tar.gz, .tgz)")
+    parser.add_argument('--archive-manifest', action='store_true',
+                        help="con --archive: aggiungi manifest.json con l'indice di utenti e file")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="con --batch: ricerca, generazione e scrittura in parallelo (pipeline asincrona); "
+                             "non aggiorna lo snapshot")
+    parser.add_argument('--from-snapshot', action='store_true',
+                        help="genera le firme dallo snapshot locale degli utenti, senza collegarsi ad AD")
+    parser.add_argument('--snapshot', default=SNAPSHOT_FILE,
+                        help=f"file dello snapshot locale degli utenti (default: {SNAPSHOT_FILE})")
+    parser.add_argument('--snapshot-ttl', type=int, default=DEFAULT_SNAPSHOT_TTL,
+                        help="validità dello snapshot in secondi")
+    parser.add_argument('--office-version',
+                        help=f"versione di Office per la firma predefinita (default: {DEFAULT_OFFICE_VERSION})")
+    parser.add_argument('--reg-file',
+                        help="scrivi la firma predefinita in questo file .reg (uno per tutto il batch)")
+    parser.add_argument('--defaults-manifest',
+                        help="scrivi chiave, valori e utenti della firma predefinita in questo file JSON")
+    parser.add_argument('--no-registry', action='store_true',
+                        help="non scrivere la firma predefinita nel registro dell'utente corrente")
+    parser.add_argument('--asset-mode', choices=ASSET_MODES,
+                        help="immagini di ASSETS incorporate nella firma (inline) o collegate accanto (files)")
+    parser.add_argument('--render-cache', type=int, default=DEFAULT_RENDER_CACHE_SIZE,
+                        help=f"firme generate tenute in memoria, 0 per disattivare (default: {DEFAULT_RENDER_CACHE_SIZE})")
+    parser.add_argument('--quiet', action='store_true',
+                        help="nessun messaggio per singolo file/utente (solo errori e riepiloghi)")
+    parser.add_argument('--metrics',
+                        help="con --batch: esporta tempi e contatori per fase in questo file")
+    parser.add_argument('--metrics-format', choices=METRICS_FORMATS, default='jsonl',
+                        help="formato di --metrics: righe JSON accodate (jsonl) o textfile Prometheus")
+    return parser
+
+
+def main(argv=None):
+    parser = build_arg_parser()
+    args = parser.parse_args(argv)
+    if args.pipeline and (args.processes or args.incremental or args.archive):
+        parser.error("--pipeline non si può combinare con --processes, --incremental o --archive")
+    settings = load_settings()
+    settings['EXCLUDED_OUS'] = list(settings['EXCLUDED_OUS']) + args.exclude_ou
+    for key, value in (('OFFICE_VERSION', args.office_version), ('REG_FILE', args.reg_file),
+                       ('DEFAULTS_MANIFEST', args.defaults_manifest)):
+        if value:
+            settings[key] = value
+    if args.no_registry:
+        settings['SET_DEFAULT_SIGNATURE'] = False
+    if args.asset_mode:
+        settings['ASSET_MODE'] = args.asset_mode
     
-    print("="*100 + "\n")
+    if args.watch:
+        return run_watch(args, settings)
 
+    if args.serve:
+        return run_serve(args, settings)
 
-def main():
+    if args.batch:
+        with redirect_stdout(sys.stderr):
+            summary, exit_code = run_batch(args, settings)
+        print(json.dumps(summary, ensure_ascii=False))
+        return exit_code
+    
     print("""
 ╔══════════════════════════════════════════════════════════════╗
 ║   Gestore Firme Email: Active Directory -> Outlook          ║
@@ -439,38 +3865,40 @@ def main():
     print("Configurazione Active Directory")
     print("=" * 60)
     
-    AD_SERVER = "adds.google.com"
-    DOMAIN = "GOOGLE"
-    BASE_DN = "DC=adds,DC=GOOGLE,DC=com"  # BASE DN CORRETTO!
+    AD_SERVER = settings['AD_SERVER']
+    DOMAIN = settings['DOMAIN']
+    BASE_DN = settings['BASE_DN']
     
-    print(f"Server: {AD_SERVER}")
+    print(f"Server: {AD_SERVER if isinstance(AD_SERVER, str) else ', '.join(AD_SERVER)}")
     print(f"Dominio: {DOMAIN}")
     print(f"Base DN: {BASE_DN}")
     print("=" * 60)
     
     # Chiedi sede per filtrare utenti
+    sede_filters = {key: (sede['nome'], sede['ou']) for key, sede in settings['SEDI'].items()}
+    all_key = str(len(sede_filters) + 1)
+    parallel_key = str(len(sede_filters) + 2)
+    
     print("\nSede da gestire:")
-    print("1. Italy")
-    print("2. Roma")
-    print("3. Spain")
-    print("4. Germania")
-    print("5. Tutte le sedi")
-    
-    sede_choice = input("\nScegli sede (1-5): ").strip()
-    
-    sede_filters = {
-        '1': ('Italy', 'OU=Treviso,OU=rIT,OU=Client,DC=adds,DC=google,DC=com'),
-        '2': ('Roma', 'OU=Perugia,OU=rIT,OU=Client,DC=adds,DC=google,DC=com'),
-        '3': ('Spain', 'OU=Verona,OU=rIT,OU=Client,DC=adds,DC=google,DC=com'),
-        '4': ('Germania', 'OU=rDE,OU=Client,DC=adds,DC=google,DC=com'),
-        '5': ('Tutte', 'DC=adds,DC=google,DC=com')
-    }
+    for key, (name, _) in sede_filters.items():
+        print(f"{key}. {name}")
+    print(f"{all_key}. Tutte le sedi")
+    print(f"{parallel_key}. Tutte le sedi (ricerca parallela per OU)")
+    
+    sede_choice = input(f"\nScegli sede (1-{parallel_key}): ").strip()
     
-    sede_name, search_base = sede_filters.get(sede_choice, sede_filters['5'])
+    # Con l'ultima opzione le OU delle singole sedi vengono interrogate in parallelo
+    parallel_bases = None
+    if sede_choice == parallel_key:
+        parallel_bases = {name: ou for name, ou in sede_filters.values()}
+    
+    sede_filters[all_key] = ('Tutte', BASE_DN)
+    sede_name, search_base = sede_filters.get(sede_choice, sede_filters[all_key])
     print(f"\n→ Sede selezionata: {sede_name}")
     print(f"→ Ricerca in: {search_base}")
     
-    USERNAME = input("\nUsername AD: ").strip() or "dom.Bob"
+    default_username = os.environ.get('AD_USERNAME') or "dom.Bob"
+    USERNAME = input(f"\nUsername AD (default: {default_username}): ").strip() or default_username
     
     # Password in modo sicuro
     import getpass
@@ -481,19 +3909,9 @@ def main():
     
     print("\n" + "=" * 60)
     
-    # Inizializza manager
-    manager = ADSignatureManager(AD_SERVER, DOMAIN, search_base, USERNAME, PASSWORD)
-    
-    # Opzione: personalizza info azienda
-    manager.company_info.update({
-        'nome': 'Google',
-        'indirizzo': 'Address',  # PERSONALIZZA
-        'website': 'www.google.com',
-        'logo_url': 'https://www.google.com/logo.png',  # PERSONALIZZA
-        'colore_primario': '#0066cc',
-        'colore_secondario': '#666666',
-        'disclaimer': 'Questo messaggio è confidenziale. Se non siete il destinatario, vi preghiamo di eliminarlo.'
-    })
+    # Inizializza manager (info azienda da COMPANY_INFO in config.py)
+    manager = create_manager(settings, USERNAME, PASSWORD, search_base,
+                             render_cache=RenderCache(args.render_cache), quiet=args.quiet)
     
     # Connetti ad AD
     if not manager.connect_to_ad():
@@ -505,15 +3923,26 @@ def main():
     print("\nCerca utenti in Active Directory...")
     search_query = input("Inserisci filtro ricerca (lascia vuoto per tutti della sede): ").strip()
     
-    if search_query:
-        ldap_filter = f"(&(objectClass=user)(|(sAMAccountName=*{search_query}*)(displayName=*{search_query}*)(mail=*{search_query}*)))"
-    else:
-        ldap_filter = "(&(objectClass=user)(mail=*))"
+    ldap_filter = build_search_filter(search_query, contains=args.contains,
+                                      exclude_disabled=settings['EXCLUDE_DISABLED'] and not args.include_disabled)
+    
+    if args.incremental:
+        bases = list(parallel_bases.values()) if parallel_bases else None
+        run_incremental_sync(manager, ldap_filter, bases, args.output, full=args.full, max_workers=args.workers)
+        return
     
     print(f"\nAvvio ricerca con filtro LDAP...")
     
     try:
-        users = manager.search_users(ldap_filter)
+        if parallel_bases:
+            print(f"→ Ricerca parallela su {len(parallel_bases)} OU...")
+            users, latencies = manager.search_multiple_ous(parallel_bases, ldap_filter)
+            users = UserStore(users)
+            print(f"\n✓ Trovati {len(users)} utenti con email valida "
+                  f"(OU più lenta: {max(latencies.values(), default=0):.2f}s)")
+        else:
+            # Gli utenti vanno direttamente nello store su disco, una pagina alla volta
+            users = manager.search_users(ldap_filter, store=UserStore())
     except Exception as e:
         print(f"\n✗ ERRORE durante la ricerca: {e}")
         import traceback
@@ -533,8 +3962,9 @@ def main():
             new_base_dn = input("Inserisci nuovo BASE DN (es: OU=Users,DC=cartongrp,DC=com): ").strip()
             if new_base_dn:
                 manager.base_dn = new_base_dn
+                parallel_bases = None
                 try:
-                    users = manager.search_users(ldap_filter)
+                    users = manager.search_users(ldap_filter, store=UserStore())
                 except Exception as e:
                     print(f"✗ Errore: {e}")
         
@@ -542,8 +3972,23 @@ def main():
             input("\nPremi Invio per chiudere...")
             return
     
-    # Mostra utenti
-    display_users(users)
+    # Salva gli utenti nello snapshot locale (per --from-snapshot); le OU la cui
+    # ricerca è fallita non compaiono in latencies e restano come erano
+    try:
+        if parallel_bases:
+            bases = [base_dn for name, base_dn in parallel_bases.items() if name in latencies]
+        else:
+            bases = [manager.base_dn]
+        snapshot = UserSnapshot(args.snapshot, args.snapshot_ttl)
+        try:
+            update_snapshot(snapshot, users, bases, complete=not search_query)
+        finally:
+            snapshot.close()
+    except Exception as e:
+        print(f"⚠ Snapshot locale non aggiornato: {e}")
+    
+    # Mostra utenti (una pagina alla volta)
+    browse_users(users)
     
     # Menu selezione
     while True:
@@ -552,15 +3997,16 @@ def main():
         print("2. Aggiorna firma per più utenti (selezione multipla)")
         print("3. Salva firme in cartella locale (distribuzione manuale)")
         print("4. Esci")
+        print("5. Sfoglia / cerca utenti")
         
-        choice = input("\nScegli opzione (1-4): ").strip()
+        choice = input("\nScegli opzione (1-5): ").strip()
         
         if choice == "1":
             # Singolo utente
             try:
-                user_num = int(input(f"Inserisci numero utente (1-{len(users)}): "))
-                if 1 <= user_num <= len(users):
-                    selected_user = users[user_num - 1]
+                selected = select_users(users, input(f"Inserisci numero utente (1-{len(users)}), username o email: "))
+                if len(selected) == 1:
+                    selected_user = selected[0]
                     print(f"\n→ Aggiornamento firma per: {selected_user['display_name']}")
                     
                     target_username = input(f"Username Windows (default: {selected_user['username']}): ").strip()
@@ -571,74 +4017,78 @@ def main():
                         print(f"✓ Firma aggiornata con successo per {selected_user['display_name']}")
                     else:
                         print(f"✗ Errore nell'aggiornamento della firma")
+                    manager.finish_writes()
                 else:
-                    print("Numero non valido")
+                    print("Indica un solo utente valido")
             except ValueError:
                 print("Input non valido")
         
         elif choice == "2":
             # Multipli utenti
-            user_numbers = input(f"Inserisci numeri utenti separati da virgola (es: 1,3,5): ").strip()
-            try:
-                selected_nums = [int(n.strip()) for n in user_numbers.split(',')]
-                valid_nums = [n for n in selected_nums if 1 <= n <= len(users)]
+            user_numbers = input(f"Inserisci numeri, username o email separati da virgola (es: 1,3,mrossi): ").strip()
+            selected_users = select_users(users, user_numbers)
+            
+            if selected_users:
+                print(f"\n→ Aggiornamento firme per {len(selected_users)} utenti...")
                 
-                if valid_nums:
-                    print(f"\n→ Aggiornamento firme per {len(valid_nums)} utenti...")
-                    
-                    for num in valid_nums:
-                        selected_user = users[num - 1]
-                        print(f"\n  [{num}/{len(valid_nums)}] {selected_user['display_name']}")
-                        
-                        if manager.deploy_signature_to_user(selected_user):
-                            print(f"  ✓ Completato")
-                        else:
-                            print(f"  ✗ Errore")
-                    
-                    print(f"\n✓ Processo completato per {len(valid_nums)} utenti")
-                else:
-                    print("Nessun numero valido inserito")
-            except ValueError:
-                print("Input non valido")
+                results = manager.deploy_batch(selected_users, max_workers=args.workers)
+                
+                manager.finish_writes()
+                failed = sum(1 for r in results if not r.ok)
+                print(f"\n✓ Processo completato per {len(selected_users)} utenti ({failed} errori)")
+            else:
+                print("Nessun utente valido inserito")
         
         elif choice == "3":
             # Salva in cartella locale
-            output_folder = input("Cartella output (default: ./firme): ").strip()
+            output_folder = input("Cartella output o archivio .zip/.tar.gz (default: ./firme): ").strip()
             if not output_folder:
                 output_folder = "./firme"
             
-            user_numbers = input(f"Utenti da esportare (es: 1,2,3 o 'tutti'): ").strip().lower()
+            user_numbers = input(f"Utenti da esportare (es: 1,2,mrossi o 'tutti'): ").strip()
             
-            if user_numbers == "tutti":
+            if user_numbers.lower() == "tutti":
                 selected_users = users
             else:
-                try:
-                    selected_nums = [int(n.strip()) for n in user_numbers.split(',')]
-                    selected_users = [users[n-1] for n in selected_nums if 1 <= n <= len(users)]
-                except:
+                selected_users = select_users(users, user_numbers)
+                if not selected_users:
                     print("Input non valido")
                     continue
             
             print(f"\n→ Salvataggio {len(selected_users)} firme in {output_folder}...")
-            for user in selected_users:
-                manager.save_signature_to_file(user, output_folder)
-            
-            print(f"\n✓ {len(selected_users)} firme salvate con successo")
+            if is_archive_path(output_folder):
+                try:
+                    results = manager.export_archive(selected_users, output_folder, with_manifest=True,
+                                                     processes=args.processes)
+                except OSError as e:
+                    print(f"✗ Errore creazione archivio: {e}")
+                    continue
+            else:
+                results = manager.deploy_batch(selected_users, output_folder, max_workers=args.workers,
+                                               processes=args.processes)
+                manager.finish_writes()
+            saved = sum(1 for r in results if r.ok)
+            print(f"\n✓ {saved}/{len(selected_users)} firme salvate con successo")
         
         elif choice == "4":
+            stats = manager.render_cache.stats()
+            print(f"\n→ Cache firme: {stats['hits']} hit, {stats['misses']} miss ({stats['hit_rate']:.0%})")
             print("\nArrivederci!")
             break
         
+        elif choice == "5":
+            browse_users(users)
+        
         else:
             print("Opzione non valida")
 
 
 if __name__ == "__main__":
     try:
-        main()
+        sys.exit(main())
     except KeyboardInterrupt:
         print("\n\nInterrotto dall'utente.")
     except Exception as e:
         print(f"\n✗ Errore: {e}")
-        import traceback
-        traceback.print_exc()
\ No newline at end of file
+        traceback.print_exc()
+        sys.exit(2)
\ No newline at end of file